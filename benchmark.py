@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  benchmark.py
+#
+#  Copyright 2015 Peter Persson <peter.johan.persson@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import os
+import sys
+import json
+import random
+import platform
+import tempfile
+import tracemalloc
+import numpy
+from time import perf_counter
+from argparse import ArgumentParser
+
+from hmm import HMM
+from model import Model, CHUNK
+from syntaxtranslator import Translator
+from textutils import ConllParser, ConllReader
+
+#  tags, dependency types and chunk tags used in synthetic corpora, 
+#  tags past the universal tags are numbered
+UNIVERSAL_TAGS = ['NOUN', 'VERB', 'ADJ', 'ADV', 'PRON', 'DET', 'ADP', 
+				  'NUM', 'CONJ', 'PRT', '.', 'X']
+DEP_TYPES = ['nsubj', 'dobj', 'iobj', 'amod', 'advmod', 'det', 'adpmod',
+			 'adpobj', 'cc', 'mark', 'aux', 'ccomp', 'xcomp', 'p', 'num']
+CHUNK_TAGS = ['B-NP', 'I-NP', 'B-VC', 'I-VC', 'B-PP', 'B-AP', 'O']
+
+def generate_corpus(filename, sentence_N, tag_N=12, vocabulary_N=5000,
+					oov_rate=0.0, mean_length=15.0, max_length=80,
+					seed=0):
+	"""Writes a synthetic .conll corpus with stanford dependencies
+
+	Every tag has its own share of the vocabulary, drawn with a Zipf
+	like skew, and tags follow each other with a fixed random bias so
+	that the transitions can be learned. Sentence lengths are drawn
+	from a geometric distribution with mean_length, capped at
+	max_length. A share oov_rate of the tokens are drawn from a
+	vocabulary that is different for every seed, so a corpus made
+	with another seed has these tokens out of vocabulary. Every
+	sentence is a connected dependency tree rooted in its first token,
+	which has one of the universal tags so that it can be translated.
+
+	Returns the number of tokens written."""
+	rand = random.Random(seed)
+	structure = random.Random(0) #  same tags and words for every seed
+	tags = (UNIVERSAL_TAGS + ['T' + str(n) for n in 
+			range(len(UNIVERSAL_TAGS), tag_N)])[:tag_N]
+	words = [[tag.lower() + '_' + str(n)
+				for n in range(max(1, vocabulary_N // tag_N))]
+					for tag in tags]
+	following = [structure.sample(range(tag_N), min(3, tag_N))
+					for tag in tags]
+	token_N = 0
+	with open(filename, 'w') as outf:
+		for s in range(sentence_N):
+			length = 1
+			while length < max_length and \
+					rand.random() > 1.0 / max(mean_length, 1.0):
+				length += 1
+			q = rand.randrange(min(tag_N, len(UNIVERSAL_TAGS)))
+			for i in range(1, length + 1):
+				if rand.random() < oov_rate:
+					token = 'oov' + str(seed) + '_' + str(rand.randrange(
+								vocabulary_N))
+				else:
+					vocabulary = words[q]
+					token = vocabulary[int(len(vocabulary)
+										* rand.random() ** 3)]
+				parent = 0 if i == 1 else rand.randrange(1, i)
+				dep = 'ROOT' if i == 1 else rand.choice(DEP_TYPES)
+				outf.write("\t".join([str(i), token, '_', tags[q], tags[q],
+									  rand.choice(CHUNK_TAGS), str(parent),
+									  dep, '_', '_']) + "\n")
+				if rand.random() < 0.8: q = rand.choice(following[q])
+				else: q = rand.randrange(tag_N)
+			outf.write("\n")
+			token_N += length
+	return token_N
+
+def read_sentences(filename, bulk=False):
+	"""Returns the token lists of the sentences of a .conll file
+
+	The file is read a line at a time by ConllParser, or in bulk by
+	ConllReader if bulk is set."""
+	if bulk:
+		with ConllReader(filename) as reader:
+			return [tokens for tokens, raw_lines in reader.iter_sentences()]
+	with open(filename, 'r') as inf:
+		return [tokens for tokens, raw_lines
+					in ConllParser().iter_sentences(inf)]
+
+def measure(function, token_N, repeat=1, memory=True):
+	"""Times function and measures its peak memory
+
+	function is run repeat times and the fastest run counts. With
+	memory set it is run once more with tracemalloc, which slows it
+	down, to find the most memory allocated at once.
+
+	Returns dict of seconds, tokens, tokens per second and peak memory
+	in bytes"""
+	seconds = []
+	for n in range(repeat):
+		start = perf_counter()
+		function()
+		seconds.append(perf_counter() - start)
+	result = {'seconds': min(seconds), 'tokens': token_N,
+			  'tokens_per_sec': token_N / max(min(seconds), 1e-9)}
+	if memory:
+		tracemalloc.start()
+		function()
+		result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	return result
+
+def run(args):
+	"""Generates corpora in a temporary directory and benchmarks them
+
+	Returns the results with the configuration as a JSON ready dict"""
+	config = {'sentences': args.sentences, 'tags': args.tags,
+			  'vocabulary': args.vocabulary, 'oov_rate': args.oov_rate,
+			  'mean_length': args.mean_length,
+			  'max_length': args.max_length, 'seed': args.seed,
+			  'repeat': args.repeat}
+	results = {}
+	def bench(name, function, token_N):
+		results[name] = measure(function, token_N, args.repeat,
+								not args.no_memory)
+		print("{:<20}{:12.0f} tokens/s".format(name,
+				results[name]['tokens_per_sec']), file=sys.stderr)
+	with tempfile.TemporaryDirectory() as tmp:
+		train_file = os.path.join(tmp, 'train.conll')
+		test_file = os.path.join(tmp, 'test.conll')
+		corpus = dict(tag_N=args.tags, vocabulary_N=args.vocabulary,
+					  mean_length=args.mean_length,
+					  max_length=args.max_length)
+		train_N = generate_corpus(train_file, args.sentences,
+								  seed=args.seed, **corpus)
+		test_N = generate_corpus(test_file, max(1, args.sentences // 10),
+								 oov_rate=args.oov_rate,
+								 seed=args.seed + 1, **corpus)
+		config['train_tokens'], config['test_tokens'] = train_N, test_N
+		#  reading
+		bench('read_lines', lambda: read_sentences(train_file), train_N)
+		bench('read_bulk', lambda: read_sentences(train_file, True),
+			  train_N)
+		#  training
+		pos_model, chunk_model = Model(), Model()
+		bench('train_pos', lambda: pos_model.train(train_file), train_N)
+		bench('train_chunk',
+			  lambda: chunk_model.train(train_file, mode=CHUNK), train_N)
+		#  model i/o
+		for binary in (False, True):
+			suffix = '_binary' if binary else '_pickle'
+			filename = os.path.join(tmp, 'pos' + suffix)
+			bench('save' + suffix,
+				  lambda: pos_model.save_at(filename, binary=binary),
+				  train_N)
+			results['save' + suffix]['bytes'] = os.path.getsize(filename)
+			bench('load' + suffix, lambda: Model().load_from(filename),
+				  train_N)
+		#  decoding
+		hmm = HMM()
+		sentences = read_sentences(test_file)
+		pos_model.freeze()
+		for log_space in (False, True):
+			bench('viterbi_log' if log_space else 'viterbi',
+				  lambda: [hmm.viterbi(tokens, pos_model, log_space)
+							for tokens in sentences], test_N)
+		bench('viterbi_batch',
+			  lambda: hmm.viterbi_batch(sentences, pos_model), test_N)
+		#  translation of dependencies to chunks
+		translator = Translator()
+		translated = os.path.join(tmp, 'translated.conll')
+		bench('annotate_file',
+			  lambda: translator.annotate_file(test_file, translated),
+			  test_N)
+	return {'config': config,
+			'environment': {'python': platform.python_version(),
+							'numpy': numpy.__version__,
+							'platform': platform.platform()},
+			'results': results}
+
+def init_args():
+	parser = ArgumentParser(description="Benchmarks reading, training, decoding, translation and model i/o on synthetic corpora.")
+	parser.add_argument("-o", "--output", type=str, help="write results as JSON to this file instead of standard output")
+	parser.add_argument("-s", "--sentences", type=int, default=2000, help="sentences in the training corpus, the test corpus has a tenth")
+	parser.add_argument("--tags", type=int, default=12, help="size of the tagset")
+	parser.add_argument("--vocabulary", type=int, default=5000, help="size of the vocabulary")
+	parser.add_argument("--oov-rate", type=float, default=0.05, help="share of test tokens not in the training corpus")
+	parser.add_argument("--mean-length", type=float, default=15.0, help="mean sentence length")
+	parser.add_argument("--max-length", type=int, default=80, help="longest sentence length")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the random corpora")
+	parser.add_argument("-r", "--repeat", type=int, default=1, help="time each benchmark this many times and keep the fastest")
+	parser.add_argument("--no-memory", action="store_true", help="skip the extra traced run that measures peak memory")
+	return parser.parse_args()
+
+def main(args):
+	results = run(args)
+	if args.output:
+		with open(args.output, 'w') as outf:
+			json.dump(results, outf, indent=2)
+	else:
+		json.dump(results, sys.stdout, indent=2)
+		print()
+
+if __name__ == '__main__':
+	main(init_args())
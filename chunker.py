@@ -22,13 +22,21 @@
 #  
 # 
 
+from time import perf_counter
+_START = perf_counter() #  start of program for --timing
+
 import pickle
 import os
-from hmm import HMM 
-from model import Model
-from textutils import ConllParser
-from argparse import ArgumentParser
+import sys
+from itertools import islice, tee
+from contextlib import contextmanager
+from operator import itemgetter
+from textutils import ConllParser, ConllReader, ConllWriter
+from lrucache import LRUCache
+from instrumentation import Stats
+from argparse import ArgumentParser, ArgumentTypeError
 
+#  hmm and model import numpy, so they are imported once first needed
 
 #These constants are used for ease-of-reading purposes
 CHUNK = 0
@@ -47,6 +55,28 @@ class Chunker:
 		chunk_model (Model): the model object trained for chunking 
 		hmm (HMM): the HMM object used together with either model to 
 			perform tagging operations
+		log_space (bool): decode with log probabilities, which keeps 
+			long sentences from underflowing
+		model_files (dict): filepaths of loaded models by mode, used 
+			by worker processes to load the same models
+		model_cache_size (int): size of the caches of loaded models, 
+			which are frozen for inference
+		beam (float): beam threshold of loaded models, see Model
+		beam_width (int): most states in the beam of loaded models, or 
+			0 for no limit
+		sentence_cache (LRUCache): tags of recently tagged sentences by
+			tuple of tokens and mode, not used if its maxsize is 0
+		stats (Stats): time per stage and counts of the tagging, or 
+			None when not instrumented
+		stage_stats (dict): busy seconds of each stage and depths of 
+			its output queue from the last pipelined tag_file, or None
+		handoff (numpy.ndarray): the chunk model emission int of every
+			POS model state int, or None unless both models are loaded 
+			and the chunk model knows every POS tag
+		first_written (float): perf_counter() time at which the first
+			sentence was written, or None
+		shared_memory (bool): publish the models in shared memory for 
+			worker processes to attach to, instead of each loading them
 	methods:
 		load_model(filename[, mode]): filename is the filepath for the 
 			file containing the model to be loaded, mode is an int 
@@ -57,23 +87,102 @@ class Chunker:
 			be saved, chunktagging model or postagging model
 		tag(tokens, mode): finds pos tags for tokens, if mode is set 
 			to chunk find chunk tags to the generate pos tags
-		tag_file(infile[, outfile, mode]): generate annotated version of
-			file at infile, output either to terminal or outfile
+		tag_batch(sentences, mode): like tag, for a list of sentences
+		tag_stream(sentences[, mode, batch_size, workers]): generates 
+			tags for an iterable of sentences, lazily
+		write_sentence(raw_lines, out_sequence[, outfile, mode]): 
+			outputs one annotated sentence
+		write_stream(raw_sentences, out_sequences[, outfile, mode]):
+			outputs annotated sentences as their tags are generated
+		tag_file(infile[, outfile, mode, batch_size, workers]): 
+			generate annotated version of file at infile, output either
+			to terminal or outfile
+		stats_summary(): returns stats with cache counters as dict
 	
 	"""
-	def __init__(self):
+	def __init__(self, log_space=False, model_cache_size=10000, 
+				 beam=1/1000, beam_width=0, sentence_cache_size=0, 
+				 stats=False, shared_memory=False):
+		from hmm import HMM
 		self.pos_model = None
 		self.chunk_model = None
 		self.hmm = HMM()
+		self.log_space = log_space
+		self.model_files = {}
+		self.model_cache_size = model_cache_size
+		self.beam = beam
+		self.beam_width = beam_width
+		self.sentence_cache = LRUCache(sentence_cache_size)
+		self.stats = Stats() if stats else None
+		self.first_written = None
+		self.handoff = None
+		self.stage_stats = None
+		self.shared_memory = shared_memory
 	
-	def load_model(self, filename, mode=CHUNK):
-		"""Makes new model object by loading from filepath"""
+	def load_model(self, filename, mode=CHUNK, shared=None):
+		"""Makes new model object by loading from filepath
+		
+		If shared is given the model is instead attached to the shared 
+		memory block of that name, see Model.share. Loaded models are 
+		only used for tagging, so they are frozen."""
+		from model import Model
+		if self.stats: start = perf_counter()
+		self.model_files[mode] = filename
+		model = Model(self.beam, self.beam_width)
+		if shared: 
+			model.attach(shared)
+		else:
+			model.load_from(filename)
+		model.freeze(self.model_cache_size)
 		if mode == CHUNK: 
-			self.chunk_model = Model()
-			self.chunk_model.load_from(filename)
+			if self.chunk_model: self.chunk_model.detach()
+			self.chunk_model = model
 		if mode == POS: 
-			self.pos_model = Model()
-			self.pos_model.load_from(filename)
+			if self.pos_model: self.pos_model.detach()
+			self.pos_model = model
+			self.pos_model.emissions.stats = self.stats
+		self._link_models()
+		if self.stats: self.stats.lap('load', start)
+	
+	def _settings(self):
+		"""Returns arguments that make a Chunker decode like this one"""
+		return (self.log_space, self.model_cache_size, self.beam, 
+				self.beam_width, 0, self.stats is not None)
+	
+	@contextmanager
+	def _shared_models(self):
+		"""Publishes the loaded models in shared memory while in use
+		
+		Yields the names of the blocks by mode, empty unless 
+		shared_memory is set. The blocks are destroyed on exit, once the
+		workers attached to them are done."""
+		from model import release_shared
+		shared = {}
+		try:
+			if self.shared_memory:
+				for mode, model in ((POS, self.pos_model), 
+									(CHUNK, self.chunk_model)):
+					if model: shared[mode] = model.share(self.log_space)
+			yield shared
+		finally:
+			for name in shared.values():
+				release_shared(name)
+	
+	def _link_models(self):
+		"""Maps POS states to chunk emissions once both are loaded
+		
+		The POS paths can then be handed to the chunk model as ints, 
+		without decoding them to tags and converting these again."""
+		from numpy import array, intp
+		self.handoff = None
+		self.stage_stats = None
+		if self.pos_model and self.chunk_model:
+			tags = self.pos_model.converter.get_states()
+			handoff = array(self.chunk_model.converter.convert_tokens(
+								*tags), dtype=intp)
+			#  tags unknown to the chunk model are left to its converter
+			if (handoff < self.chunk_model.get_emission_N()).all():
+				self.handoff = handoff
 	
 	def save_model(self, filename, mode=CHUNK):
 		"""Tells model object to save at filepath"""
@@ -98,91 +207,531 @@ class Chunker:
 		POST: returns list of chunk tags if mode is 0 (CHUNK) or list 
 			of PoS tags if mode is 1 (POS)
 		"""
+		out_sequence = self._cached(tokens, mode)
+		if out_sequence is None:
+			out_sequence = self._tag(tokens, mode)
+			self._cache(tokens, mode, out_sequence)
+		return out_sequence
+	
+	def _cached(self, tokens, mode):
+		"""Returns copy of cached tags of tokens in mode, or None"""
+		if self.sentence_cache.maxsize <= 0: return None
+		try:
+			return list(self.sentence_cache[tuple(tokens), mode])
+		except KeyError:
+			return None
+	
+	def _cache(self, tokens, mode, out_sequence):
+		"""Caches tags of tokens in mode, unless caching is off"""
+		if self.sentence_cache.maxsize > 0 and out_sequence is not None:
+			self.sentence_cache[tuple(tokens), mode] = tuple(out_sequence)
+	
+	def _tag(self, tokens, mode):
+		"""Decodes tags of tokens as tag does, without the cache"""
+		stats = self.stats
+		if stats: start = perf_counter()
 		if self.pos_model:
 			if self.chunk_model and mode == CHUNK:
-				pos_nums = self.hmm.viterbi(tokens, self.pos_model)
-				pos_tags = self.pos_model.converter.decode_tags(*pos_nums)
-				chunk_nums = self.hmm.viterbi(pos_tags, self.chunk_model)
+				pos_nums = self.hmm.viterbi(tokens, self.pos_model, 
+											self.log_space)
+				if stats: start = stats.lap('pos', start)
+				if self.handoff is not None:
+					chunk_nums = self.hmm.viterbi(None, self.chunk_model, 
+								self.log_space, self.handoff[list(pos_nums)])
+				else:
+					pos_tags = self.pos_model.converter.decode_tags(*pos_nums)
+					chunk_nums = self.hmm.viterbi(pos_tags, self.chunk_model, 
+												  self.log_space)
 				chunk_tags = self.chunk_model.converter.decode_tags(*chunk_nums)
+				if stats: stats.lap('chunk', start)
 				return chunk_tags
 			elif mode == CHUNK: print("No model for chunk tagging.")
 			else:
-				pos_tags = self.hmm.viterbi(tokens, self.pos_model)
+				pos_nums = self.hmm.viterbi(tokens, self.pos_model, 
+											self.log_space)
+				pos_tags = self.pos_model.converter.decode_tags(*pos_nums)
+				if stats: stats.lap('pos', start)
+				return pos_tags
+		else: print("No model for part-of-speech pre-processing.")
+	
+	def tag_batch(self, sentences, mode=CHUNK):
+		"""Finds chunk or PoS tags for a list of token lists
+		
+		Works like tag but decodes all sentences through the batched 
+		viterbi of the hmm object, which runs sentences of equal length
+		together.
+		
+		PRE: sentences is a list of lists of strings representing 
+			tokens, mode if specified is 0 (CHUNK) or 1 (POS)
+		POST: returns a list with one list of chunk or PoS tags per 
+			sentence, following mode as in tag
+		"""
+		out_sequences = [self._cached(tokens, mode) for tokens in sentences]
+		missing = [n for n, out_sequence in enumerate(out_sequences) 
+						if out_sequence is None]
+		if not missing: return out_sequences
+		found = self._tag_batch([sentences[n] for n in missing], mode)
+		if found is None: return
+		for n, out_sequence in zip(missing, found):
+			out_sequences[n] = out_sequence
+			self._cache(sentences[n], mode, out_sequence)
+		return out_sequences
+	
+	def _tag_batch(self, sentences, mode):
+		"""Decodes tags of sentences as tag_batch does, without cache"""
+		if self.pos_model:
+			if mode == CHUNK and not self.chunk_model:
+				print("No model for chunk tagging.")
+				return
+			stats = self.stats
+			if stats: start = perf_counter()
+			pos_converter = self.pos_model.converter
+			pos_paths = self.hmm.viterbi_batch(sentences, self.pos_model, 
+											   self.log_space)
+			if mode == POS: 
+				pos_tags = [pos_converter.decode_tags(*path) 
+								for path in pos_paths]
+				if stats: stats.lap('pos', start)
 				return pos_tags
+			if stats: start = stats.lap('pos', start)
+			chunk_converter = self.chunk_model.converter
+			if self.handoff is not None:
+				chunk_paths = self.hmm.viterbi_batch(None, self.chunk_model,
+								self.log_space, 
+								[self.handoff[list(path)] for path in pos_paths])
+			else:
+				pos_tags = [pos_converter.decode_tags(*path) 
+								for path in pos_paths]
+				chunk_paths = self.hmm.viterbi_batch(pos_tags, 
+								self.chunk_model, self.log_space)
+			chunk_tags = [chunk_converter.decode_tags(*path) 
+							for path in chunk_paths]
+			if stats: stats.lap('chunk', start)
+			return chunk_tags
 		else: print("No model for part-of-speech pre-processing.")
 	
-	def tag_file(self, infile, outfile=None, mode=CHUNK):
+	def tag_stream(self, sentences, mode=CHUNK, batch_size=1, workers=1):
+		"""Lazily finds chunk or PoS tags for an iterable of sentences
+		
+		Sentences are pulled from the iterable only as they are needed,
+		batch_size at a time, and tag sequences are generated in the 
+		order of the sentences. With more than one worker the decoding 
+		is done by a pool of worker processes, see _tag_parallel.
+		
+		PRE: sentences is an iterable of lists of strings representing
+			tokens, mode is 0 (CHUNK) or 1 (POS), batch_size and 
+			workers are positive ints
+		POST: generates one list of chunk or PoS tags per sentence
+		"""
+		if workers > 1:
+			yield from self._tag_parallel(sentences, mode, batch_size, 
+										  workers)
+			return
+		sentences = iter(sentences)
+		while True:
+			batch = list(islice(sentences, batch_size))
+			if not batch: break
+			if len(batch) > 1:
+				yield from self.tag_batch(batch, mode)
+			else:
+				yield self.tag(batch[0], mode)
+	
+	def _tag_parallel(self, sentences, mode, batch_size, workers):
+		"""Generates tags of sentences decoded by worker processes
+		
+		Each worker loads the models from the files they were loaded 
+		from by this chunker, once, or attaches to them in shared memory
+		if shared_memory is set. Sentences are read a window at a 
+		time and handed to the workers in blocks, longest sentences 
+		first so that no worker is left alone with a long block at the
+		end of a window. Tags are generated in the original order. 
+		Sentences in the sentence cache are not handed to the workers, 
+		and tags found by the workers are cached here, so the cache is 
+		shared by all workers. Sentences repeated within a window are 
+		only handed to the workers once when caching.
+		"""
+		from multiprocessing import Pool
+		BLOCK_N = max(batch_size, 32) #  sentences per block of work
+		WINDOW_N = BLOCK_N * workers * 16 #  sentences read at a time
+		sentences = iter(sentences)
+		caching = self.sentence_cache.maxsize > 0
+		with self._shared_models() as shared, \
+				Pool(workers, initializer=_init_worker, 
+					 initargs=(self.model_files, self._settings(), 
+							   shared)) as pool:
+			while True:
+				window = list(islice(sentences, WINDOW_N))
+				if not window: break
+				out_sequences, first = [None] * len(window), {}
+				for n, tokens in enumerate(window):
+					if tuple(tokens) in first: continue
+					out_sequences[n] = self._cached(tokens, mode)
+					if out_sequences[n] is None and caching:
+						first[tuple(tokens)] = n
+				if caching:
+					order = list(first.values())
+				else:
+					order = range(len(window))
+				order = sorted(order, key=lambda n: -len(window[n]))
+				blocks = [[(n, window[n]) for n in order[i:i + BLOCK_N]]
+							for i in range(0, len(order), BLOCK_N)]
+				for block, stats in pool.imap_unordered(_tag_block, 
+						[(block, mode, batch_size) for block in blocks]):
+					if stats: self.stats.add(stats)
+					for n, out_sequence in block:
+						out_sequences[n] = out_sequence
+						self._cache(window[n], mode, out_sequence)
+				#  repeats within the window share the tags of the first
+				for n, tokens in enumerate(window):
+					if out_sequences[n] is None:
+						out_sequences[n] = list(
+							out_sequences[first[tuple(tokens)]])
+				yield from out_sequences
+	
+	def write_sentence(self, raw_lines, out_sequence, outfile=None, 
+					   mode=CHUNK):
+		"""Writes raw_lines with out_sequence in the tag column
+		
+		PRE: raw_lines are the .conll lines of one sentence and 
+			out_sequence holds one tag per line
+		POST: the annotated lines are written to outfile, or to 
+			standard output when there is no outfile
+		"""
+		outfile = outfile or sys.stdout
+		column = 5 if mode == CHUNK else 3
+		for i, tag in enumerate(out_sequence):
+			data = raw_lines[i].split("\t")
+			data[column] = tag
+			outfile.write("\t".join(data))
+	
+	def write_stream(self, raw_sentences, out_sequences, outfile=None, 
+					 mode=CHUNK, writer=None):
+		"""Writes annotated sentences as their tags are generated
+		
+		With a writer the tags are spliced in by the ConllWriter, and 
+		raw_sentences are the offsets of each sentence instead of its 
+		lines, see ConllReader.offsets. The first sentence is flushed 
+		at once.
+		
+		PRE: raw_sentences is an iterable of the .conll lines of each 
+			sentence and out_sequences an iterable of their tags
+		POST: the annotated lines are written to outfile, or to 
+			standard output when there is no outfile
+		"""
+		for raw_lines, out_sequence in zip(raw_sentences, out_sequences):
+			if self.stats: start = perf_counter()
+			if writer: writer.splice(raw_lines, out_sequence)
+			else: self.write_sentence(raw_lines, out_sequence, outfile, mode)
+			if self.stats: self.stats.lap('write', start)
+			if self.first_written is None:
+				if writer: writer.flush()
+				self.first_written = perf_counter()
+	
+	def _tag_pipeline(self, infile, outfile, mode, batch_size):
+		"""Tags and writes infile with each stage in its own worker
+		
+		A reader thread parses blocks of sentences, a process per model
+		decodes them and this thread writes them out. The stages are 
+		connected by bounded queues, so they overlap across blocks 
+		while only a few blocks are in flight. Every stage records the 
+		time it was busy, which excludes waiting on the queues, and the 
+		depth of its output queue after each block. These are kept in 
+		stage_stats to show which stage is the bottleneck. With 
+		shared_memory set the stage processes attach to the models in 
+		shared memory.
+		"""
+		stages = [POS] if mode == POS else [POS, CHUNK]
+		if POS not in self.model_files:
+			print("No model for part-of-speech pre-processing.")
+			return
+		if CHUNK in stages and CHUNK not in self.model_files:
+			print("No model for chunk tagging.")
+			return
+		with self._shared_models() as shared:
+			self._run_pipeline(infile, outfile, mode, batch_size, stages,
+							   shared)
+	
+	def _run_pipeline(self, infile, outfile, mode, batch_size, stages, 
+					  shared):
+		"""Runs the stages of _tag_pipeline, attaching to shared models"""
+		from multiprocessing import Process, Queue
+		from threading import Thread
+		from queue import Queue as LocalQueue
+		BLOCK_N = max(batch_size, 16) #  sentences per block
+		QUEUE_N = 8 #  blocks held by a queue between two stages
+		queues = [Queue(QUEUE_N) for n in range(len(stages) + 1)]
+		raw_queue = LocalQueue() #  lines of sentences read, in order
+		processes = [Process(target=_run_stage, daemon=True, 
+							 args=(stage, mode, self.model_files[stage], 
+								   shared.get(stage), self._settings(), 
+								   self.handoff, batch_size, queues[n], 
+								   queues[n + 1]))
+						for n, stage in enumerate(stages)]
+		for process in processes: process.start()
+		reader = Thread(target=_read_stage, daemon=True, 
+						args=(infile, BLOCK_N, queues[0], raw_queue))
+		reader.start()
+		busy = 0.0
+		while True:
+			block = _get_block(queues[-1], processes)
+			if isinstance(block, dict): break
+			start = perf_counter()
+			for out_sequence in block:
+				self.write_sentence(raw_queue.get(), out_sequence, outfile,
+									mode)
+				if self.first_written is None:
+					self.first_written = perf_counter()
+			busy += perf_counter() - start
+		reader.join()
+		for process in processes: process.join()
+		stats = block
+		if 'error' in stats:
+			raise RuntimeError("Pipeline reader failed: " + stats['error'])
+		stats['write'] = {'busy': busy}
+		self.stage_stats = stats
+		if self.stats:
+			for name in ('read', 'pos', 'chunk', 'write'):
+				if name in stats: 
+					self.stats.seconds[name] += stats[name]['busy']
+			self.stats.counts['sentences'] += stats['read']['sentences']
+			self.stats.counts['tokens'] += stats['read']['tokens']
+			for worker_stats in stats.pop('worker_stats', []):
+				self.stats.add(worker_stats)
+	
+	def tag_file(self, infile, outfile=None, mode=CHUNK, batch_size=1, 
+				 workers=1, pipeline=False):
 		"""reads a .conll file and annotates with PoS or chunk tags
 		
-		Reads through a .conll file one sentence at a time, deliminated 
-		by blank lines, and runs the tag function on each list of 
-		tokens generated. The original lines are stored as strings and 
-		the new annotation is added when at the appropriate column when 
-		a sentence has been decoded, and are then outputted or written 
-		to a file. 
+		Streams the sentences of a .conll file, deliminated by blank 
+		lines, through tag_stream and write_stream. Files on disk are 
+		memory mapped and read in bulk, and the tags are spliced into 
+		their bytes by offset when outfile is binary or has a binary 
+		buffer in the same encoding, see _tag_spliced. The original lines
+		are kept until their sentence has been decoded, then the new 
+		annotation is added at the appropriate column and they are 
+		written out. Only the sentences in flight are held in memory.
+		
+		With pipeline set, reading, POS decoding, chunk decoding and 
+		writing run concurrently instead, see _tag_pipeline. workers is
+		then ignored.
 		
-		PRE: infile is filepath to a .conll file, mode is 0 (CHUNK) or 
-			1 (POS), outfile if specified is the filepath for storing 
-			generated annotated file
+		PRE: infile is a .conll file object, mode is 0 (CHUNK) or 
+			1 (POS), outfile if specified is the file object for storing
+			generated annotated file, batch_size and workers are 
+			positive ints
 		POST: the contents of infile will be annotated with chunk or 
 			PoS tags and outputtet either in terminal or at outfile
 		"""
-		parser = ConllParser()
-		sentence, raw_lines = [], []
-		line = infile.readline()
-		while line:
-			# if line isn't empty use it
-			if line != "\n":
-				token = parser.parse_line_TAG(line)
-				sentence.append(token)
-				raw_lines.append(line)
-			# if end of sentence that is non empty
-			elif len(sentence) > 0:
-				out_sequence = self.tag(sentence, mode)
-				if outfile:
-					column = 5 if mode == CHUNK else 3
-					for i, tag in enumerate(out_sequence):
-						data = raw_lines[i].split("\t")
-						data[column] = tag
-						outfile.write("\t".join(data))
-				else:
-					print(out_sequence)
-				sentence = []
-			line = infile.readline()
-				
-	
-	@staticmethod
-	def test_UD(filename, filesize):
-		parser = ConllParser()
-		test_pos_model = "pos_model_UD_en.pickle"
-		test_chunk_model = "chunk_model_UD_en.pickle"
-		chunker = Chunker()
-		chunker.load_model(test_pos_model, mode=POS)
-		chunker.load_model(test_chunk_model, mode=CHUNK)
-		correct_n, total_n, line_n, progress = 0, 0, 0, 0
-		with open(filename, 'r') as inf:
-			sentence, chunks = [], []
-			line = inf.readline()
-			while line:
-				if line != "\n":
-					token, chunk = parser.parse_line_EVAL(line)
-					sentence.append(token)
-					chunks.append(chunker.chunk_model.converter.convert_state(chunk))
-				else:
-					if len(sentence) > 0:
-						guesses = chunker.tag(sentence, mode=CHUNK)
-						for i in range(len(chunks)):
-							if chunks[i] == guesses[i]: correct_n += 1
-							total_n += 1
-						sentence, chunks = [], []
-						progress_value = int(line_n * 100 / filesize / 10)
-						if progress_value > progress:
-							progress = progress_value
-							print( str(progress * 10) + "%")
-							print("Accuracy:", correct_n / float(total_n))
-				line_n += 1
-				line = inf.readline()
-		print("Final accuracy:", correct_n / float(total_n))
+		if pipeline:
+			return self._tag_pipeline(infile, outfile, mode, batch_size)
+		encoding = getattr(infile, 'encoding', None) or 'utf-8'
+		if ConllReader.mappable(infile) and \
+				ConllWriter.writable(outfile or sys.stdout, encoding):
+			return self._tag_spliced(infile, outfile, mode, batch_size, 
+									 workers, encoding)
+		sentences = ConllParser().iter_sentences(infile)
+		if self.stats: sentences = self._read_counted(sentences)
+		tokens, raw_lines = tee(sentences)
+		out_sequences = self.tag_stream(map(itemgetter(0), tokens), mode,
+										batch_size, workers)
+		self.write_stream(map(itemgetter(1), raw_lines), out_sequences, 
+						  outfile, mode)
+	
+	def _tag_spliced(self, infile, outfile, mode, batch_size, workers,
+					 encoding='utf-8'):
+		"""Tags a .conll file on disk like tag_file, splicing the tags
+		
+		A ConllReader finds the tokens and the offsets of the tag column
+		of each sentence, and a ConllWriter copies the lines with the 
+		tags spliced in at these offsets, in large writes. infile is 
+		read and outfile written in encoding, tag_file only takes this
+		path when outfile accepts its bytes."""
+		column = ConllParser.CHUNK if mode == CHUNK else ConllParser.TAG
+		with ConllReader(infile, encoding=encoding) as reader, \
+				ConllWriter(outfile or sys.stdout, reader.buffer, 
+							encoding=encoding) as writer:
+			sentences = reader.offsets(column, ConllParser.TOKEN)
+			if self.stats: sentences = self._read_counted(sentences)
+			spans, tokens = tee(sentences)
+			out_sequences = self.tag_stream(map(itemgetter(1), tokens), 
+											mode, batch_size, workers)
+			self.write_stream(map(itemgetter(0), spans), out_sequences, 
+							  writer=writer)
+	
+	def stats_summary(self):
+		"""Returns summary of stats with the caches of this process
+		
+		Stage times of worker processes are summed, so they can add up 
+		to more than the wall time. Cache counters are those of this 
+		process only."""
+		caches = {}
+		if self.sentence_cache.maxsize > 0:
+			caches['sentence'] = self.sentence_cache.stats()
+		if self.pos_model:
+			oov = self.pos_model.emissions.oov_cache.stats()
+			if oov['hits'] or oov['misses']: caches['oov'] = oov
+		return self.stats.summary(caches)
+	
+	def _read_counted(self, sentences):
+		"""Generates sentences, timing and counting them in stats
+		
+		The first item of each sentence has an entry per token."""
+		stats = self.stats
+		while True:
+			start = perf_counter()
+			try:
+				sentence = next(sentences)
+			except StopIteration:
+				return
+			stats.lap('read', start)
+			stats.counts['sentences'] += 1
+			stats.counts['tokens'] += len(sentence[0])
+			yield sentence
+
+def _iter_sentences(infile):
+	"""Generates (tokens, raw_lines) of the sentences of infile
+	
+	Regular files are read in bulk by a ConllReader, others such as 
+	pipes a line at a time by ConllParser.iter_sentences."""
+	if ConllReader.mappable(infile):
+		with ConllReader(infile) as reader:
+			yield from reader.iter_sentences()
+	else:
+		yield from ConllParser().iter_sentences(infile)
+
+#  chunker of a worker process in Chunker._tag_parallel
+_worker_chunker = None
+
+def _init_worker(model_files, settings, shared):
+	"""Loads the models of a worker process, attaching shared models"""
+	global _worker_chunker
+	_worker_chunker = Chunker(*settings)
+	for mode, filename in model_files.items():
+		_worker_chunker.load_model(filename, mode=mode, 
+								   shared=shared.get(mode))
+	if _worker_chunker.stats: _worker_chunker.stats.clear()
+
+def _tag_block(args):
+	"""Tags a block of (index, tokens) in a worker process"""
+	block, mode, batch_size = args
+	sentences = [sentence for n, sentence in block]
+	if batch_size > 1:
+		out_sequences = _worker_chunker.tag_batch(sentences, mode)
+	else:
+		out_sequences = [_worker_chunker.tag(sentence, mode) 
+							for sentence in sentences]
+	stats = None
+	if _worker_chunker.stats:
+		stats = _worker_chunker.stats.as_dict()
+		_worker_chunker.stats.clear()
+	return [(n, out_sequence) for (n, sentence), out_sequence 
+				in zip(block, out_sequences)], stats
+
+def _queue_depth(queue):
+	"""Returns number of blocks in queue, 0 where this is unsupported"""
+	try:
+		return queue.qsize()
+	except NotImplementedError:
+		return 0
+
+def _put_block(queue, block, stats):
+	"""Puts block in queue and records the depth of the queue"""
+	queue.put(block)
+	depth = _queue_depth(queue)
+	stats['blocks'] += 1
+	stats['queue_mean'] += (depth - stats['queue_mean']) / stats['blocks']
+	stats['queue_max'] = max(stats['queue_max'], depth)
+
+def _get_block(queue, processes):
+	"""Gets next block from queue, failing if a stage process died"""
+	from queue import Empty
+	while True:
+		try:
+			return queue.get(timeout=1)
+		except Empty:
+			if any(process.exitcode for process in processes):
+				raise RuntimeError("Pipeline stage process failed")
+
+def _new_stage_stats():
+	return {'busy': 0.0, 'blocks': 0, 'queue_mean': 0.0, 'queue_max': 0}
+
+def _read_stage(infile, block_N, outq, raw_queue):
+	"""Reads blocks of tokens for Chunker._tag_pipeline
+	
+	The lines of each sentence go to raw_queue, its tokens to outq. The
+	block that ends the pipeline is a dict of stage statistics."""
+	stats = _new_stage_stats()
+	stats['sentences'], stats['tokens'] = 0, 0
+	end = {'read': stats}
+	try:
+		sentences = _iter_sentences(infile)
+		while True:
+			start = perf_counter()
+			block = []
+			for tokens, raw_lines in islice(sentences, block_N):
+				block.append(tokens)
+				raw_queue.put(raw_lines)
+				stats['tokens'] += len(tokens)
+			stats['sentences'] += len(block)
+			stats['busy'] += perf_counter() - start
+			if not block: break
+			_put_block(outq, block, stats)
+	except Exception as e:
+		end['error'] = repr(e)
+	outq.put(end)
+
+def _run_stage(stage, mode, model_file, shared, settings, handoff, 
+			   batch_size, inq, outq):
+	"""Decodes blocks with one model in a Chunker._tag_pipeline process
+	
+	The POS stage passes POS paths on as chunk model emission ints when
+	there is a handoff (see Chunker._link_models), otherwise as tags. 
+	Both stages decode to tags if they are the last stage."""
+	chunker = Chunker(*settings)
+	chunker.load_model(model_file, mode=stage, shared=shared)
+	if chunker.stats: chunker.stats.clear()
+	model = chunker.pos_model if stage == POS else chunker.chunk_model
+	hmm, converter, log_space = chunker.hmm, model.converter, \
+								chunker.log_space
+	stats = _new_stage_stats()
+	while True:
+		block = inq.get()
+		if isinstance(block, dict): break
+		start = perf_counter()
+		if stage == CHUNK and handoff is not None:
+			if batch_size > 1:
+				paths = hmm.viterbi_batch(None, model, log_space, block)
+			else:
+				paths = [hmm.viterbi(None, model, log_space, observations)
+							for observations in block]
+		elif batch_size > 1:
+			paths = hmm.viterbi_batch(block, model, log_space)
+		else:
+			paths = [hmm.viterbi(tokens, model, log_space) 
+						for tokens in block]
+		if stage == POS and mode == CHUNK and handoff is not None:
+			block = [handoff[list(path)] for path in paths]
+		else:
+			block = [converter.decode_tags(*path) for path in paths]
+		stats['busy'] += perf_counter() - start
+		_put_block(outq, block, stats)
+	block['pos' if stage == POS else 'chunk'] = stats
+	if chunker.stats:
+		block.setdefault('worker_stats', []).append(chunker.stats.as_dict())
+	outq.put(block)
+
+def beam_arg(value):
+	"""Argument type of --beam, a float above 0 and at most 1"""
+	beam = float(value)
+	if not 0 < beam <= 1:
+		raise ArgumentTypeError("must be above 0 and at most 1")
+	return beam
+
+def beam_width_arg(value):
+	"""Argument type of --beam-width, an int of 0 or more"""
+	beam_width = int(value)
+	if beam_width < 0: raise ArgumentTypeError("must be 0 or more")
+	return beam_width
 
 def init_args():
 	parser = ArgumentParser(description="Simple bilingual monogram-based machine translator.")
@@ -192,10 +741,29 @@ def init_args():
 	parser.add_argument("-o", "--output", type=str, nargs=1, help="specify file for output")
 	parser.add_argument("-O", "--only-pos", action="store_true", help="only do POS preprocessing")
 	parser.add_argument("-t", "--train", action="store_true", help="train models from files instead of loading")
+	parser.add_argument("-B", "--binary", action="store_true", help="save trained models in memory mappable binary format")
+	parser.add_argument("-b", "--batch-size", type=int, default=1, help="decode this many sentences together")
+	parser.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes used for tagging or training")
+	parser.add_argument("--beam", type=beam_arg, default=1/1000, help="prune states less probable than this times the best (default 0.001)")
+	parser.add_argument("--beam-width", type=beam_width_arg, default=0, help="keep at most this many states per column in the beam, 0 for no limit")
+	parser.add_argument("--sentence-cache", type=int, default=0, help="remember the tags of this many recent sentences, 0 to turn off")
+	parser.add_argument("--pipeline", action="store_true", help="read, decode POS, decode chunks and write concurrently")
+	parser.add_argument("--shared-memory", action="store_true", help="with -w or --pipeline, publish the models once in shared memory for the workers")
+	parser.add_argument("--stats", action="store_true", help="print time per stage, counts, OOV rate, cache hits and throughput")
+	parser.add_argument("--stats-json", type=str, help="write the --stats summary as JSON to this file")
+	parser.add_argument("--timing", action="store_true", help="report import, model load and first sentence latency")
+	parser.add_argument("-l", "--log-space", action="store_true", help="decode with log probabilities (stable on long sentences)")
 	return parser.parse_args()
 	
 def main(args):
-	chunker = Chunker()
+	timings = {'start': _START}
+	#  creating the chunker imports the decoder and numpy
+	chunker = Chunker(log_space=args.log_space, beam=args.beam, 
+					  beam_width=args.beam_width, 
+					  sentence_cache_size=args.sentence_cache, 
+					  stats=args.stats or bool(args.stats_json), 
+					  shared_memory=args.shared_memory)
+	timings['import'] = perf_counter()
 	outfile = None
 	mode = ''
 	
@@ -224,9 +792,13 @@ def main(args):
 			print("Error while unpickling: is data corrupt?", args.pos_model[0])					
 			if outfile: outfile.close()
 			return
+		except ValueError as e:
+			print("Error while loading model:", e, args.pos_model[0])
+			if outfile: outfile.close()
+			return
 	
-	# if there is a chunk model, load it
-	if args.chunk_model and not args.train:
+	# if there is a chunk model that will be used, load it
+	if args.chunk_model and mode == CHUNK and not args.train:
 		try:
 			chunker.load_model(args.chunk_model[0], mode=CHUNK)
 		except IOError:
@@ -243,35 +815,105 @@ def main(args):
 			if outfile: outfile.close()
 			return
 		
+	timings['load'] = perf_counter()
+	
 	# determine if models should be trained rather than used
 	if args.train:
+		from model import Model
 		if args.pos_model: 
 			pos_m = Model()
-			pos_m.train(args.files[0])
-			pos_m.save_at(args.pos_model)
+			pos_m.train(args.files[0], workers=args.workers)
+			pos_m.save_at(args.pos_model[0], binary=args.binary)
 		else:
 			print("Use -p argument to specify outpath for trained POS model")
 		if args.chunk_model: 
 			chunk_m = Model()
-			chunk_m.train(args.files[0], mode=CHUNK)
-			chunk_m.save_at(args.chunk_model)
+			chunk_m.train(args.files[0], mode=CHUNK, workers=args.workers)
+			chunk_m.save_at(args.chunk_model[0], binary=args.binary)
 	# models are not to be trained, use them to tag!	
 	else:
 		for string in args.files:
-			if string == args.output[0]:
+			if args.output and string == args.output[0]:
 				print(args.output[0], "is both input and output. ")
 				break
 			try:
 				with open(string, 'r') as f:
-					chunker.tag_file(f, outfile=outfile, mode=mode)
+					chunker.tag_file(f, outfile=outfile, mode=mode, 
+									 batch_size=args.batch_size, 
+									 workers=args.workers,
+									 pipeline=args.pipeline)
 			except IOError as e:
-				pring("Can't open", string)
+				print("Can't open", string)
 	
 	if outfile: outfile.close()
+	if chunker.stats and not args.train:
+		summary = chunker.stats_summary()
+		if args.stats: print_stats(summary)
+		if args.stats_json:
+			import json
+			with open(args.stats_json, 'w') as outf:
+				json.dump(summary, outf, indent=2)
+	if args.timing and not args.train:
+		timings['end'] = perf_counter()
+		print_timings(timings, chunker.first_written)
+		if chunker.stage_stats: print_stage_stats(chunker.stage_stats)
+		if chunker.sentence_cache.maxsize > 0:
+			print_cache_stats(chunker.sentence_cache.stats())
+		for name, model in (("pos", chunker.pos_model), 
+							("chunk", chunker.chunk_model)):
+			if model and model.pruning['sentences']:
+				print_pruning_stats(name, model.pruning_stats())
+
+def print_timings(timings, first_written):
+	"""Prints cold start report of main to standard error"""
+	report = [("import", timings['import'] - timings['start']),
+			  ("load", timings['load'] - timings['import'])]
+	if first_written:
+		report.append(("first sentence", first_written - timings['load']))
+	report.append(("total", timings['end'] - timings['start']))
+	for name, seconds in report:
+		print("{:<16}{:8.3f} s".format(name, seconds), file=sys.stderr)
+
+def print_stats(summary):
+	"""Prints a Chunker.stats_summary() to standard error"""
+	counts = summary['counts']
+	print("{} sentences, {} tokens in {:.3f} s, {:.0f} tokens/s".format(
+			counts.get('sentences', 0), counts.get('tokens', 0), 
+			summary['wall_seconds'], summary['tokens_per_sec']), 
+		  file=sys.stderr)
+	print("OOV rate {:.2%}".format(summary['oov_rate']), file=sys.stderr)
+	for stage in ('load', 'read', 'pos', 'oov', 'chunk', 'write'):
+		if stage in summary['stages']:
+			stats = summary['stages'][stage]
+			print("{:<8}{:8.3f} s {:7.1%}".format(stage, stats['seconds'], 
+					stats['share']), file=sys.stderr)
+	for name, stats in summary.get('caches', {}).items():
+		print("{:<16} hits {hits}  misses {misses}  evictions "
+			  "{evictions}".format(name + " cache", **stats), file=sys.stderr)
+
+def print_cache_stats(stats):
+	"""Prints size and counters of the sentence cache"""
+	print("sentence cache {size}/{maxsize}  hits {hits}  misses {misses}"
+		  "  evictions {evictions}".format(**stats), file=sys.stderr)
+
+def print_pruning_stats(name, stats):
+	"""Prints beam sizes and evaluated cells of decoding with a model"""
+	print("{:<8}beam mean {:6.2f} max {:d}  cells per token {:9.1f}".format(
+			name, stats['beam_mean'], stats['beam_max'], 
+			stats['cells_per_token']), file=sys.stderr)
+
+def print_stage_stats(stage_stats):
+	"""Prints busy time and output queue depths of pipeline stages"""
+	for name in ('read', 'pos', 'chunk', 'write'):
+		if name not in stage_stats: continue
+		stats = stage_stats[name]
+		line = "{:<8}busy {:8.3f} s".format(name, stats['busy'])
+		if 'blocks' in stats:
+			line += "  queue mean {:5.2f} max {:d}".format(
+						stats['queue_mean'], stats['queue_max'])
+		print(line, file=sys.stderr)
 
 if __name__ == '__main__':
 	args = init_args()
 	main(args)
-	#Chunker.test_UD("/home/peterpersson/lin503/projekt/universal_treebanks_v2.0/std/de-universal-test.conll", 17330)
-	#Chunker.test_UD("/home/peterpersson/lin503/projekt/universal_treebanks_v1.0/en-universal-test.conll", 59100)
 
@@ -30,17 +30,45 @@ class Converter:
 	Contains mappings of tags, tokens, and suffixes to integer 
 	representations to be used in calculations. These mappings are 
 	stored in one dict per type of symbol (i.e. one for tokens, one for 
-	tags, etc.)"""
+	tags, etc.)
+	
+	A frozen converter never learns new symbols, which keeps it from 
+	growing during long running tagging. Unknown emissions are then all
+	converted to one shared OOV int, one past the last known emission, 
+	and unknown states likewise to one past the last known state. The 
+	sorted symbol lists used for decoding are kept while frozen, they 
+	are only sorted once first needed."""
+	
+	frozen = False #  converters pickled before freezing existed
 	
 	def __init__(self):
 		self.emission_index = {}
 		self.state_index = {}
 		self.suffix_index = {}
+		self.frozen = False
+	
+	def freeze(self, frozen=True):
+		"""Stops, or resumes if frozen is False, learning new symbols"""
+		self.state_list, self.emission_list = None, None
+		self.frozen = frozen
+	
+	def forget_emissions(self, emission_N):
+		"""Forgets the emissions with int names of emission_N or more
+		
+		Used to drop the emissions learned while decoding with an 
+		unfrozen converter, which come after those of training."""
+		self.emission_index = {e: n for e, n in self.emission_index.items()
+									if n < emission_N}
+		self.emission_list = None
 	
 	def convert_emission(self, e):
+		if self.frozen:
+			return self.emission_index.get(e, len(self.emission_index))
 		return self.emission_index.setdefault(e, len(self.emission_index))
 	
 	def convert_state(self, q):
+		if self.frozen:
+			return self.state_index.get(q, len(self.state_index))
 		return self.state_index.setdefault(q, len(self.state_index))
 	
 	def convert_suffix(self, s):
@@ -52,16 +80,24 @@ class Converter:
 		
 	def get_states(self):
 		"""Returns a sorted list of states"""
-		return sorted(list(self.state_index.keys()), 
+		if self.frozen and self.state_list is not None: 
+			return self.state_list
+		states = sorted(list(self.state_index.keys()), 
 					key=lambda x: self.state_index[x])
+		if self.frozen: self.state_list = states
+		return states
 	
 	def get_state_N(self):
 		return len(self.state_index)
 	
 	def get_emissions(self):
 		"""Returns a sorted list of emissions"""
-		return sorted(list(self.emission_index.keys()), 
+		if self.frozen and self.emission_list is not None: 
+			return self.emission_list
+		emissions = sorted(list(self.emission_index.keys()), 
 					key=lambda x: self.emission_index[x])
+		if self.frozen: self.emission_list = emissions
+		return emissions
 	
 	def get_emission_N(self):
 		return len(self.emission_index)
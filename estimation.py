@@ -24,7 +24,10 @@
 
 from numpy import *
 
-from collections import MutableMapping, Counter
+from time import perf_counter
+from collections import Counter
+from collections.abc import MutableMapping
+from lrucache import LRUCache
 
 class EmissionHandler(MutableMapping):
 	"""dict-like container that handles emission probability estimation
@@ -33,7 +36,8 @@ class EmissionHandler(MutableMapping):
 	found in the training data and allows accessing of this information 
 	as though from a dict. If a key is given that does not yet have a 
 	value then the emission probability is estimated based on the suffix
-	of the token and then cached for later use. 
+	of the token, using a table of suffix estimates for all states that
+	is computed during training. 
 	
 	When used in the chunking model no smoothing is necessary since 
 	every state/emission pair is seen in the training data (when using 
@@ -44,10 +48,23 @@ class EmissionHandler(MutableMapping):
 		Q_counts (Counter): raw frequencies of states (from training)
 		S_counts (Counter): raw frequencies of suffixes (from training)
 		Q_S_counts (Counter): raw frequencies of state/suffic tuples
-		array (numpy.ndarray): normalized array containing emission Ps
-			for state/emission pairs found in training data
-		found (dict): caches state/emission pairs found outside of
-			training data
+		emission_N (int): number of emissions found in training data
+		indptr (numpy.ndarray): emission e has its entries in states 
+			and probs at indptr[e]:indptr[e + 1]
+		states (numpy.ndarray): states of the state/emission pairs 
+			found in training data, sorted per emission
+		probs (numpy.ndarray): normalized emission Ps of those pairs
+		log_probs (numpy.ndarray): log of probs, built when first 
+			needed and not pickled with the handler
+		found (dict): stores Ps set for state/emission pairs
+		suffix_index (dict): row of each training suffix (of max 
+			length 10) in suffix_table, the empty suffix has row 0
+		suffix_table (numpy.ndarray): smoothed P(state | suffix) 
+			estimates of every suffix for all states
+		oov_cache (LRUCache): suffix estimates of recently seen unknown
+			tokens, not pickled with the handler
+		stats (Stats): records time spent on and number of unknown 
+			tokens when set, not pickled with the handler
 		token_N (int): number of tokens in training data
 		theta (float): weight constant used in smoothing
 		converter: converter object used by model
@@ -55,21 +72,65 @@ class EmissionHandler(MutableMapping):
 	methods:
 		add(key): increments frequency of state/emission pair by one
 		_P_estimate(*args): estimates P for (state,suffix) or state
-		normalize(state_N, emission_N)): create array attribute from
-			raw frequencies stored in data attribute
+		normalize(state_N, emission_N)): create sparse emission Ps 
+			from raw frequencies stored in data attribute
 		train(Q_counts, S_counts, Q_S_counts, token_N): set attributes
-			and calculate theta attribute
+			and calculate theta attribute and the suffix table
+		suffix_column(token): returns suffix estimates of token for 
+			every state
+		build_suffix_table(): computes suffix_table from the counts
 		__getitem__(key): returns emission P if found, otherwise
-			caches and returns an estimate"""
+			caches and returns an estimate
+		column(e, state_N[, token]): returns array of emission Ps of e
+			for every state
+		log_column(e, state_N[, token]): returns array of emission log
+			Ps of e for every state"""
 	def __init__(self, converter):
 		self.data = Counter()
 		self.Q_counts = Counter()
 		self.S_counts = Counter()
 		self.Q_S_counts = Counter()
 		self.token_N = 0
-		self.array = zeros((1,1))
+		self.theta = 0.0
+		self.emission_N = 0
+		self.indptr = zeros(1, dtype=intp)
+		self.states = zeros(0, dtype=int32)
+		self.probs = zeros(0)
+		self.log_probs = None
 		self.converter = converter
 		self.found = dict()
+		self.suffix_index = {'': 0}
+		self.suffix_table = None
+		self.oov_cache = LRUCache()
+		self.stats = None
+	
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['log_probs'] = None
+		state['stats'] = None
+		state['oov_cache'] = LRUCache(self.oov_cache.maxsize)
+		return state
+	
+	def __setstate__(self, state):
+		#  older models stored emission Ps in a dense array
+		if 'array' in state:
+			dense = asarray(state.pop('array'))
+			state.pop('log_array', None)
+			emissions, states = dense.T.nonzero()
+			state['emission_N'] = dense.shape[1]
+			state['indptr'] = concatenate(([0], cumsum(bincount(
+								emissions, minlength=dense.shape[1]))))
+			state['states'] = states.astype(int32)
+			state['probs'] = dense[states, emissions]
+		state['log_probs'] = None
+		#  older models estimated suffixes one state at a time
+		state.setdefault('suffix_index', {'': 0})
+		state.setdefault('suffix_table', None)
+		#  chunk models are never trained for suffixes
+		state.setdefault('theta', 0.0)
+		state.setdefault('oov_cache', LRUCache())
+		state.setdefault('stats', None)
+		self.__dict__.update(state)
 	
 	def __setitem__(self, key, value):
 		self.found[key] = value
@@ -78,30 +139,85 @@ class EmissionHandler(MutableMapping):
 		"""Access stored emission Ps through (state, emission) keys
 		
 		If the key does not have a corresponding value an emission P
-		is estimated based on token suffix (of max length 10). Smoothing 
-		is done using successively shorter suffixes of the same token, 
-		as described by (Brants 2000). 
+		is estimated based on token suffix (of max length 10), see 
+		suffix_column. 
 		
 		Returns P(emission | state) as float"""
-		Q, E, MAX_M = 0, 1, 10
+		Q, E = 0, 1
 		if key in self.found:
 			return self.found[key]
-		elif key[E] >= self.array.shape[E]:
-			tag = key[Q]
+		elif key[E] >= self.emission_N:
 			token = self.converter.decode_tokens(key[E])[0]
-			#  Find longest (max M) suffix extant in training data
-			suffix = token[-min(len(token), MAX_M):]
-			while self.S_counts[suffix] == 0:
-				suffix = suffix[1:]
-			#  Successive accumulation over length 
-			acc = self._P_estimate(tag)
-			for i in range(1, len(suffix) + 1):
-				acc = (acc * self.theta + 
-						self._P_estimate(tag, suffix[-i:])) \
-									/ (1 + self.theta)
-			self.found[key] = acc
-			return self.found[key]
-		return self.array[key]
+			return self.suffix_column(token)[key[Q]]
+		lo, hi = self.indptr[key[E]], self.indptr[key[E] + 1]
+		i = lo + searchsorted(self.states[lo:hi], key[Q])
+		if i < hi and self.states[i] == key[Q]:
+			return self.probs[i]
+		return 0.0
+	
+	def column(self, e, state_N, token=None):
+		"""Access emission Ps of emission e for all states at once
+		
+		Emissions found in training data are scattered straight from 
+		their slice of the sparse Ps, other emissions are estimated from
+		the suffix of token. When token is not given it is decoded 
+		from e, which is much slower.
+		
+		Returns P(e | state) for every state as numpy.ndarray"""
+		if e < self.emission_N:
+			column = zeros(state_N)
+			lo, hi = self.indptr[e], self.indptr[e + 1]
+			column[self.states[lo:hi]] = self.probs[lo:hi]
+			return column
+		if token is None:
+			token = self.converter.decode_tokens(e)[0]
+		return self.suffix_column(token)
+	
+	def suffix_column(self, token):
+		"""Estimates emission Ps of an unseen token for all states
+		
+		The estimate is looked up in suffix_table by the longest suffix
+		(of max length 10) of token found in training data. Tokens 
+		without any such suffix get the a priori P^(state). Estimates
+		of recent tokens are kept in oov_cache.
+		
+		Returns estimated P(token | state) as numpy.ndarray"""
+		if self.stats is None:
+			return self._suffix_column(token)
+		start = perf_counter()
+		column = self._suffix_column(token)
+		self.stats.lap('oov', start)
+		self.stats.counts['oov_tokens'] += 1
+		return column
+	
+	def _suffix_column(self, token):
+		MAX_M = 10
+		try:
+			return self.oov_cache[token]
+		except KeyError:
+			pass
+		if self.suffix_table is None:
+			self.build_suffix_table()
+		suffix = token[-min(len(token), MAX_M):]
+		while suffix not in self.suffix_index:
+			suffix = suffix[1:]
+		column = self.suffix_table[self.suffix_index[suffix]]
+		self.oov_cache[token] = column
+		return column
+	
+	def log_column(self, e, state_N, token=None):
+		"""Access emission log Ps of emission e for all states at once
+		
+		Returns log P(e | state) for every state as numpy.ndarray"""
+		with errstate(divide='ignore'):
+			if e < self.emission_N:
+				if self.log_probs is None:
+					self.log_probs = log(self.probs)
+				column = full(state_N, -inf)
+				lo, hi = self.indptr[e], self.indptr[e + 1]
+				column[self.states[lo:hi]] = self.log_probs[lo:hi]
+				return column
+			return log(self.column(e, state_N, token))
 	
 	def __delitem__(self, key):
 		del self.data[key]
@@ -148,15 +264,57 @@ class EmissionHandler(MutableMapping):
 		self.theta = sum((self._P_estimate(tag) - P_bar)**2 
 									for tag in self.Q_counts) \
 							/ float(len(self.Q_counts) - 1)
+		self.build_suffix_table()
+	
+	def build_suffix_table(self):
+		"""Computes smoothed suffix estimates for all states at once
+		
+		Smoothing follows (Brants 2000): the estimate for a suffix is 
+		the estimate for the suffix one character shorter, weighted by 
+		theta, interpolated with P^(state | suffix). The empty suffix 
+		has the a priori P^(state). Suffixes are handled one length at
+		a time so that the shorter suffix is always done first."""
+		MAX_M = 10
+		state_N = self.converter.get_state_N()
+		suffixes = [''] + sorted((s for s in self.S_counts 
+									if 0 < len(s) <= MAX_M), key=len)
+		index = {s: n for n, s in enumerate(suffixes)}
+		table = zeros((len(suffixes), state_N))
+		for (q, s), count in self.Q_S_counts.items():
+			if s in index: table[index[s], q] = count
+		S_N = array([self.S_counts[s] for s in suffixes[1:]], dtype=float64)
+		table[1:] /= S_N[:, newaxis]
+		for q, count in self.Q_counts.items():
+			table[0, q] = float(count) / float(self.token_N)
+		lengths = array([len(s) for s in suffixes])
+		shorter = array([index[s[1:]] for s in suffixes[1:]], dtype=intp)
+		for m in range(1, MAX_M + 1):
+			rows = flatnonzero(lengths == m)
+			table[rows] = (table[shorter[rows - 1]] * self.theta 
+							+ table[rows]) / (1 + self.theta)
+		self.suffix_index = index
+		self.suffix_table = table
 	
 	def normalize(self, state_N, emission_N):
-		"""Normalize matrix of found state/emission pairs
+		"""Normalize found state/emission pairs into sparse emission Ps
 		
-		This method is run by the Model class during training."""
-		array = zeros((state_N, emission_N))
-		for key in self.data:
-			array[key] = self.data[key]
-		self.array = array / matrix(array.sum(axis=1)).getT()
+		Pairs are sorted by emission and then by state, so that the Ps 
+		of every emission form one slice. Each frequency is divided by 
+		the total frequency of its state without building a dense 
+		state/emission matrix. This method is run by the Model class 
+		during training."""
+		Q, E = 0, 1
+		keys = array(list(self.data.keys()), dtype=intp).reshape(-1, 2)
+		counts = fromiter(self.data.values(), float64, len(self.data))
+		order = lexsort((keys[:, Q], keys[:, E]))
+		keys, counts = keys[order], counts[order]
+		totals = bincount(keys[:, Q], weights=counts, minlength=state_N)
+		self.emission_N = emission_N
+		self.indptr = concatenate(([0], cumsum(bincount(keys[:, E], 
+											minlength=emission_N))))
+		self.states = keys[:, Q].astype(int32)
+		self.probs = counts / totals[keys[:, Q]]
+		self.log_probs = None
 	
 	def add(self, key):
 		self.data[key] += 1
@@ -175,11 +333,18 @@ class TransitionHandler():
 		unigrams (Counter): counts of unigrams
 		bigrams (Counter): counts of bigrams
 		trigrams (Counter): counts of trigrams
-		data (dict): caches previously requested transitions
+		data (dict): caches previously requested transitions when 
+			there is no array, an LRUCache once the model is frozen
+		array (numpy.ndarray): smoothed transition Ps of all state 
+			trigrams indexed [k, i, j], or None before materialize()
+		log_array (numpy.ndarray): log of array, built when first needed
 	
 	methods:
 		train(unigrams,bigram,trigram,token_N): calculates lambdas
 			using context free linear interpolation
+		materialize(state_N): builds array from the n-gram counts
+		get_array([log_space]): returns array, or log_array if 
+			log_space is set
 		__getitem__(key): calculates transition P using linear smoothing
 			unless key is already cached, then simply fetches value."""
 	def __init__(self):
@@ -188,6 +353,20 @@ class TransitionHandler():
 		self.bigrams = {}
 		self.trigrams = {}
 		self.data = dict()
+		self.array = None
+		self.log_array = None
+	
+	def __getstate__(self):
+		#  arrays are rebuilt by materialize() when the model is loaded
+		state = self.__dict__.copy()
+		state['array'], state['log_array'] = None, None
+		return state
+	
+	def __setstate__(self, state):
+		#  models pickled before the arrays existed lack the attributes
+		state.setdefault('array', None)
+		state.setdefault('log_array', None)
+		self.__dict__.update(state)
 	
 	def train(self, unigrams, bigrams, trigrams, token_N):
 		"""Calculate lambda-weights based on uni- bi- and trigram counts
@@ -212,18 +391,60 @@ class TransitionHandler():
 		self.bigrams = bigrams
 		self.trigrams = trigrams
 		self.token_N = token_N
-		for t1, t2, t3 in trigrams:
-			self[t3,t1,t2]
+		self.data = dict()
+		self.array, self.log_array = None, None
+	
+	def materialize(self, state_N):
+		"""Builds the full smoothed transition array in a single pass
+		
+		Computes the same linear interpolation as __getitem__ for every
+		state trigram at once from dense copies of the n-gram counts. 
+		This method is run by the Model class after training and after
+		loading a model."""
+		uni = zeros(state_N)
+		bi = zeros((state_N, state_N))
+		tri = zeros((state_N, state_N, state_N))
+		for counts, dense in ((self.unigrams, uni), (self.bigrams, bi), 
+							  (self.trigrams, tri)):
+			if counts:
+				keys = array(list(counts.keys())).reshape(len(counts), -1)
+				values = fromiter(counts.values(), float64, len(counts))
+				#  only keys made of states can be looked up by the model
+				valid = (keys < state_N).all(axis=1)
+				dense[tuple(keys[valid].T)] = values[valid]
+		#  p1[k], p2[j, k] and p3[i, j, k] for state trigram i, j, k
+		p1 = uni / float(self.token_N)
+		p2 = zeros((state_N, state_N))
+		divide(bi, uni[:, newaxis], out=p2, where=uni[:, newaxis] != 0)
+		p3 = zeros((state_N, state_N, state_N))
+		divide(tri, bi[:, :, newaxis], out=p3, 
+			   where=bi[:, :, newaxis] != 0)
+		self.array = ascontiguousarray(
+						self.lambdas[0] * p1[:, newaxis, newaxis] 
+						+ self.lambdas[1] * p2.T[:, newaxis, :] 
+						+ self.lambdas[2] * p3.transpose(2, 0, 1))
+		self.log_array = None
+	
+	def get_array(self, log_space=False):
+		"""Returns transition Ps (or log Ps) as array indexed [k, i, j]"""
+		if log_space and self.log_array is None:
+			with errstate(divide='ignore'):
+				self.log_array = log(self.array)
+		if log_space: return self.log_array
+		return self.array
 	
 	def __getitem__(self, key):
 		"""Returns transition P of key, estimating it if key is new
 		
 		key should be of form (k,i,j), with i,j,k being states found
-		in that order. Transition P is estimated based on context-
+		in that order. Transition P is read from the materialized array
+		when there is one, otherwise it is estimated based on context-
 		free linear smoothing using uni-, bi- and trigrams. The value
 		is then cached for later use.
 		
 		Returns transition P of key as float"""
+		if self.array is not None:
+			return self.array[key]
 		t3, t1, t2 = key #  key is states i, j, k with k first
 		if (t3, t1, t2) not in self.data:
 			p1 = self.unigrams.get(t3, 0) / float(self.token_N)
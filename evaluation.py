@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  evaluation.py
+#
+#  Copyright 2015 Peter Persson <peter.johan.persson@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import sys
+import json
+from itertools import islice
+from collections import Counter
+from time import perf_counter
+from argparse import ArgumentParser
+
+from chunker import Chunker, CHUNK, POS, beam_arg, beam_width_arg
+from textutils import ConllParser, ConllReader
+
+def iob_spans(tags):
+	"""Returns the chunks of a sequence of IOB2 tags
+
+	A chunk starts at a B- tag, or at an I- tag that does not continue
+	a chunk of its type, and runs over the I- tags of its type that
+	follow. O and any tag without a B- or I- prefix are outside chunks.
+
+	Returns a set of (start, end, type), end exclusive"""
+	spans, start, kind = set(), None, None
+	for i, tag in enumerate(tags):
+		prefix, chunk_type = tag[:2], tag[2:]
+		if prefix == 'I-' and start is not None and chunk_type == kind:
+			continue
+		if start is not None: spans.add((start, i, kind))
+		start, kind = None, None
+		if prefix in ('B-', 'I-'): start, kind = i, chunk_type
+	if start is not None: spans.add((start, len(tags), kind))
+	return spans
+
+class Scores:
+	"""Counts of a comparison of predicted against gold tags
+
+	Scores of parts of a file are added together, so that they can be
+	counted by different processes in any order.
+
+	attributes:
+		tokens (Counter): number of tokens by 'iv' (in the vocabulary
+			of the POS model) and 'oov'
+		correct (Counter): correct tags by layer ('pos' or 'chunk')
+			and 'iv' or 'oov'
+		confusion (dict): Counter of (gold, predicted) tags by layer
+		spans (Counter): gold, predicted and matching chunks by
+			(count, type), count being 'gold', 'predicted' or 'matched'
+		sentence_N (int): number of sentences
+
+	methods:
+		add_sentence(known, pos[, chunks]): counts one sentence
+		add(other): adds the counts of other Scores
+		report([seconds]): returns the scores as JSON ready dict"""
+	def __init__(self):
+		self.tokens = Counter()
+		self.correct = Counter()
+		self.confusion = {'pos': Counter(), 'chunk': Counter()}
+		self.spans = Counter()
+		self.sentence_N = 0
+
+	def add_sentence(self, known, pos, chunks=None):
+		"""Counts one sentence
+
+		known holds a bool per token, True if it is in vocabulary. pos
+		and chunks are (gold, predicted) pairs of tag lists."""
+		self.sentence_N += 1
+		layers = [('pos', pos)] + ([('chunk', chunks)] if chunks else [])
+		for i, iv in enumerate(known):
+			self.tokens['iv' if iv else 'oov'] += 1
+			for layer, (gold, predicted) in layers:
+				self.confusion[layer][gold[i], predicted[i]] += 1
+				if gold[i] == predicted[i]:
+					self.correct[layer, 'iv' if iv else 'oov'] += 1
+		if chunks:
+			gold, predicted = iob_spans(chunks[0]), iob_spans(chunks[1])
+			for name, spans in (('gold', gold), ('predicted', predicted),
+								('matched', gold & predicted)):
+				for start, end, kind in spans:
+					self.spans[name, kind] += 1
+
+	def add(self, other):
+		self.tokens.update(other.tokens)
+		self.correct.update(other.correct)
+		for layer, confusion in other.confusion.items():
+			self.confusion[layer].update(confusion)
+		self.spans.update(other.spans)
+		self.sentence_N += other.sentence_N
+
+	def report(self, seconds=0.0):
+		"""Returns the scores as JSON ready dict
+
+		For each layer scored the report holds the accuracy over all,
+		in vocabulary and out of vocabulary tokens and the confusion
+		matrix as {gold: {predicted: count}}. Chunks are also scored by
+		precision, recall and F1 of whole chunks, over all and by type.
+		"""
+		token_N = sum(self.tokens.values())
+		report = {'sentences': self.sentence_N, 'tokens': token_N,
+				  'oov_tokens': self.tokens['oov'], 'seconds': seconds,
+				  'tokens_per_sec': token_N / seconds if seconds else 0.0}
+		for layer, confusion in self.confusion.items():
+			if not confusion: continue
+			iv, oov = self.correct[layer, 'iv'], self.correct[layer, 'oov']
+			matrix = {}
+			for (gold, predicted), n in sorted(confusion.items()):
+				matrix.setdefault(gold, {})[predicted] = n
+			report[layer] = {
+				'accuracy': _ratio(iv + oov, token_N),
+				'iv_accuracy': _ratio(iv, self.tokens['iv']),
+				'oov_accuracy': _ratio(oov, self.tokens['oov']),
+				'confusion': matrix}
+		if self.confusion['chunk']:
+			kinds = sorted(set(kind for name, kind in self.spans))
+			report['chunk'].update(self._prf(None))
+			report['chunk']['types'] = {kind: self._prf(kind)
+											for kind in kinds}
+		return report
+
+	def _prf(self, kind):
+		"""Returns precision, recall and F1 of chunks of kind, or all"""
+		counts = {name: sum(n for (count, k), n in self.spans.items()
+								if count == name and kind in (None, k))
+					for name in ('gold', 'predicted', 'matched')}
+		precision = _ratio(counts['matched'], counts['predicted'])
+		recall = _ratio(counts['matched'], counts['gold'])
+		f1 = _ratio(2 * precision * recall, precision + recall)
+		counts.update(precision=precision, recall=recall, f1=f1)
+		return counts
+
+def _ratio(a, b):
+	return a / b if b else 0.0
+
+def evaluate(filename, pos_file, chunk_file=None, workers=1,
+			 batch_size=1, log_space=False, beam=1/1000, beam_width=0):
+	"""Tags the sentences of a gold .conll file and scores the tags
+
+	POS tags are predicted from the tokens and chunk tags, if there is
+	a chunk model, from the predicted POS tags, as by Chunker.tag. The
+	file is read in bulk by a ConllReader, a window of sentences at a
+	time, so that its size does not matter. With more than one worker
+	the windows are split in blocks that are tagged and scored by a
+	pool of processes which load the models once each.
+
+	Returns the report of Scores.report, timed from start to end"""
+	start = perf_counter()
+	model_files = {POS: pos_file}
+	if chunk_file: model_files[CHUNK] = chunk_file
+	settings = {'log_space': log_space, 'beam': beam,
+				'beam_width': beam_width}
+	BLOCK_N = max(batch_size, 32) #  sentences per block of work
+	scores = Scores()
+	with ConllReader(filename) as reader:
+		sentences = reader.sentences(ConllParser.TOKEN, ConllParser.TAG,
+									 ConllParser.CHUNK)
+		blocks = iter(lambda: list(islice(sentences, BLOCK_N)), [])
+		if workers > 1:
+			from multiprocessing import Pool
+			with Pool(workers, initializer=_init_worker,
+					  initargs=(model_files, settings)) as pool:
+				while True:
+					window = list(islice(blocks, workers * 4))
+					if not window: break
+					for block_scores in pool.imap_unordered(_score_block,
+							[(block, batch_size) for block in window]):
+						scores.add(block_scores)
+		else:
+			_init_worker(model_files, settings)
+			for block in blocks:
+				scores.add(_score_block((block, batch_size)))
+	return scores.report(perf_counter() - start)
+
+#  chunker of an evaluating process, see evaluate
+_worker_chunker = None
+
+def _init_worker(model_files, settings):
+	"""Loads the models of an evaluating process"""
+	global _worker_chunker
+	_worker_chunker = Chunker(**settings)
+	for mode, filename in model_files.items():
+		_worker_chunker.load_model(filename, mode=mode)
+
+def _score_block(args):
+	"""Tags and scores a block of (tokens, tags, chunks) sentences"""
+	block, batch_size = args
+	chunker, scores = _worker_chunker, Scores()
+	sentences = [tokens for tokens, tags, chunks in block]
+	if batch_size > 1:
+		pos_tags = chunker.tag_batch(sentences, POS)
+	else:
+		pos_tags = [chunker.tag(tokens, POS) for tokens in sentences]
+	chunk_tags = [None] * len(block)
+	model = chunker.chunk_model
+	if model:
+		if batch_size > 1:
+			paths = chunker.hmm.viterbi_batch(pos_tags, model,
+											  chunker.log_space)
+		else:
+			paths = [chunker.hmm.viterbi(tags, model, chunker.log_space)
+						for tags in pos_tags]
+		chunk_tags = [model.converter.decode_tags(*path)
+						for path in paths]
+	converter = chunker.pos_model.converter
+	emission_N = chunker.pos_model.emissions.emission_N
+	for (tokens, tags, chunks), predicted, predicted_chunks in zip(block,
+			pos_tags, chunk_tags):
+		known = [e < emission_N for e in converter.convert_tokens(*tokens)]
+		scores.add_sentence(known, (tags, predicted),
+							predicted_chunks and (chunks, predicted_chunks))
+	return scores
+
+def print_report(report, outfile=sys.stderr):
+	"""Prints an evaluation report as made by evaluate"""
+	print("{} sentences, {} tokens ({} out of vocabulary) in {:.3f} s, "
+		  "{:.0f} tokens/s".format(report['sentences'], report['tokens'],
+			report['oov_tokens'], report['seconds'],
+			report['tokens_per_sec']), file=outfile)
+	for layer in ('pos', 'chunk'):
+		if layer not in report: continue
+		scores = report[layer]
+		print("{:<8}accuracy {:.2%}  in vocabulary {:.2%}  out of "
+			  "vocabulary {:.2%}".format(layer, scores['accuracy'],
+				scores['iv_accuracy'], scores['oov_accuracy']),
+			  file=outfile)
+	if 'chunk' in report:
+		print("{:<8}{:>10}{:>10}{:>10}{:>8}".format("chunks", "precision",
+				"recall", "F1", "gold"), file=outfile)
+		for kind, scores in [('all', report['chunk'])] + sorted(
+				report['chunk']['types'].items()):
+			print("{:<8}{precision:10.2%}{recall:10.2%}{f1:10.2%}"
+				  "{gold:8d}".format(kind, **scores), file=outfile)
+	for layer in ('pos', 'chunk'):
+		if layer not in report: continue
+		print_confusion(layer, report[layer]['confusion'], outfile)
+
+def print_confusion(name, matrix, outfile=sys.stderr):
+	"""Prints a confusion matrix, gold tags by row"""
+	tags = sorted(set(matrix) | set(predicted for row in matrix.values()
+											for predicted in row))
+	width = max([len(tag) for tag in tags] + [len(name), 6]) + 1
+	print(name.rjust(width) + "".join(tag.rjust(width) for tag in tags),
+		  file=outfile)
+	for gold in tags:
+		row = matrix.get(gold, {})
+		print(gold.rjust(width) + "".join(str(row.get(tag, 0)).rjust(width)
+										for tag in tags), file=outfile)
+
+def init_args():
+	parser = ArgumentParser(description="Scores POS and chunk tagging against a gold .conll file.")
+	parser.add_argument("file", type=str, help="gold .conll file with POS tags and IOB2 chunk tags")
+	parser.add_argument("-p", "--pos-model", type=str, required=True, help="POS model to evaluate")
+	parser.add_argument("-c", "--chunk-model", type=str, help="chunk model to evaluate, chunks are not scored without it")
+	parser.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes")
+	parser.add_argument("-b", "--batch-size", type=int, default=1, help="decode this many sentences together")
+	parser.add_argument("-l", "--log-space", action="store_true", help="decode with log probabilities")
+	parser.add_argument("--beam", type=beam_arg, default=1/1000, help="prune states less probable than this times the best (default 0.001)")
+	parser.add_argument("--beam-width", type=beam_width_arg, default=0, help="keep at most this many states per column in the beam, 0 for no limit")
+	parser.add_argument("--json", type=str, help="also write the report as JSON to this file")
+	return parser.parse_args()
+
+def main(args):
+	report = evaluate(args.file, args.pos_model, args.chunk_model,
+					  args.workers, args.batch_size, args.log_space,
+					  args.beam, args.beam_width)
+	print_report(report, sys.stdout)
+	if args.json:
+		with open(args.json, 'w') as outf:
+			json.dump(report, outf, indent=2)
+
+if __name__ == '__main__':
+	main(init_args())
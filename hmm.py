@@ -24,24 +24,81 @@
 
 from numpy import *
 from time import time
-from operator import itemgetter
 
-from converter import Converter
-from estimation import TransitionHandler, EmissionHandler
-from model import Model
-from collections import Counter, deque
-from textutils import ConllParser
+from collections import deque
 
 
 CHUNK = 0
 POS = 1
 
+def check_beam(beam, beam_width):
+	"""Raises ValueError unless 0 < beam <= 1 and beam_width >= 0
+	
+	A beam above 1 or a negative width would leave columns with no 
+	states at all."""
+	if not 0 < beam <= 1:
+		raise ValueError("beam must be above 0 and at most 1, not " 
+						 + str(beam))
+	if beam_width < 0:
+		raise ValueError("beam width must be 0 or more, not " 
+						 + str(beam_width))
+
+def _top(beam, values, width):
+	"""Returns the width states of beam with highest values, in order
+	
+	Ties are broken in favour of the lowest states. A width of 0 leaves
+	beam as it is."""
+	if width and len(beam) > width:
+		keep = argsort(-values[beam], kind='stable')[:width]
+		return sort(beam[keep])
+	return beam
+
+def _top_mask(beam, values, width):
+	"""Limits beam masks to width states per row as _top() does"""
+	if width and (beam.sum(axis=1) > width).any():
+		keep = zeros(beam.shape, dtype=bool)
+		top = argsort(-values, axis=1, kind='stable')[:, :width]
+		put_along_axis(keep, top, True, axis=1)
+		return beam & keep
+	return beam
+
 class HMM:
-	"""Mostly superfluous class that only contains a single method.
-	See the documentation for that method."""
+	"""Mostly superfluous class that only contains decoding methods.
+	See the documentation for those methods.
+	
+	attributes:
+		backpointers (numpy.ndarray): memory reused for the 
+			backpointers of every sentence decoded, grown as needed
+	
+	methods:
+		viterbi(token_list, model[, log_space, observations]): decodes
+			one sentence
+		viterbi_batch(sentences, model[, log_space, observations]): 
+			decodes a list of
+			sentences, running sentences of equal length together"""
 	#Jungyeul Park, Mouna Chebbah, Siwar Jendoubi, Arnaud Martin. Second-Order Belief Hidden Markov Models. Belief 2014, Sep 2014, Oxford, United Kingdom. pp.284 - 293, 2014, <10.1007/978-3-319-11191-9_31>.<hal-01108238>
 	
-	def viterbi(self, token_list, model):
+	def __init__(self):
+		self.backpointers = zeros(0, dtype=int16)
+	
+	def _backpointer_array(self, shape, N_STATES):
+		"""Returns int array of shape for backpointers, filled with -1
+		
+		The array is a view of the backpointers attribute, which is 
+		only reallocated when it is too small or N_STATES does not fit 
+		its int type, so sentences of similar length share memory. The
+		-1 marks cells that decoding did not set, backtracking asserts
+		that it never reads one."""
+		size = int(prod(shape))
+		dtype = int16 if N_STATES <= iinfo(int16).max else int32
+		if self.backpointers.size < size or self.backpointers.dtype != dtype:
+			self.backpointers = empty(size + size // 2, dtype=dtype)
+		bt = self.backpointers[:size].reshape(shape)
+		bt.fill(-1)
+		return bt
+	
+	def viterbi(self, token_list, model, log_space=False, 
+				observations=None):
 		"""Find optimal hidden path for token_list using beam search
 		
 		Uses a second order HMM model and decodes the most likely state
@@ -50,98 +107,276 @@ class HMM:
 		model argument. Method and maths used is from Thorsten Brants
 		(2000) and supplemented with details from Park et al. (2014).
 		
+		In log space all probabilities are log Ps, products become sums
+		and the beam threshold becomes an additive margin below the best
+		value of a column. This keeps long sentences from underflowing.
+		
+		The beam keeps the states of a column whose value is at least 
+		model.beam times the best, and at most model.beam_width of them
+		unless that is 0. Beam sizes and evaluated cells are added to 
+		model.pruning, see Model.pruning_stats.
+		
 		arguments: 
 			token_list (list): a list of integers representing 
 				emissions (tokens when POS tagging)
 			model (Model): the model supplies transition and emission
 				probabilities as well as symbol language
+			log_space (bool): decode with log Ps instead of Ps
+			observations (sequence): the emission ints of token_list, 
+				converted from token_list if not given. token_list may 
+				then be None if all observations are known to model
+		
+		Raises ValueError if the beam of model is out of range, see 
+		check_beam.
 		
 		Returns a deque object with the most likely state path"""
-		observations = model.converter.convert_tokens(*token_list)
+		check_beam(model.beam, model.beam_width)
+		if observations is None:
+			observations = model.converter.convert_tokens(*token_list)
+		if token_list is None: token_list = [None] * len(observations)
 		#  E for emission, Q for state, T for length of input list
 		E, Q, T, N_STATES = 0, 1, len(observations), model.get_state_N()
-		BEAM_C = 1/1000 #  beam search threshold constant
-		a, b = model.transitions, model.emissions
-		bt = dict()
+		#  beam search threshold constant and maximum beam width
+		BEAM_C, BEAM_K = model.beam, model.beam_width
+		stats = model.pruning
+		stats['sentences'] += 1
+		stats['tokens'] += T
+		#  a is indexed [k, i, j], b holds one state column per token
+		if log_space:
+			mul, ZERO, BEAM_M = add, -inf, log(BEAM_C)
+			column = model.emissions.log_column
+		else:
+			mul, ZERO, BEAM_M = multiply, 0.0, BEAM_C
+			column = model.emissions.column
+		a = model.get_transition_array(log_space)
+		b = [column(e, N_STATES, token) 
+				for e, token in zip(observations, token_list)]
+		b.append(column(model.END_E, N_STATES))
 		#  viterbi if sentence is exceptionally short
 		if T == 1:
-			v0 = array([a[k, model.S0_Q, model.S1_Q] \
-						* b[k, observations[0]] \
-						* a[model.END_Q, model.S1_Q, k]
-								for k in range(N_STATES)])
+			stats['cells'] += N_STATES
+			v0 = mul(mul(a[:, model.S0_Q, model.S1_Q], b[0]), 
+						a[model.END_Q, model.S1_Q, :])
 			return [v0.argmax()]
 		if T == 2:
-			v0 = array([a[k, model.S0_Q, model.S1_Q] \
-						* b[k, observations[0]] 
-								for k in range(N_STATES)])
-			k_list = []
-			for k in range(N_STATES):
-				j_list = array([a[k, model.S1_Q, j] * v0[j] \
-								* b[k, observations[1]] \
-								* a[model.END_Q, j, k]
-									for j in range(N_STATES)])
-				k_list.append((j_list.max(), j_list.argmax()))
-			Q1, q_tuple = max(enumerate(k_list), key=itemgetter(1))
-			Q0 = q_tuple[1]
+			stats['cells'] += N_STATES + N_STATES ** 2
+			v0 = mul(a[:, model.S0_Q, model.S1_Q], b[0])
+			#  k_list[k, j] holds the value of the path j, k
+			k_list = mul(mul(mul(a[:, model.S1_Q, :], v0), 
+							 b[1][:, newaxis]), a[model.END_Q].T)
+			best_P, best_j = k_list.max(axis=1), k_list.argmax(axis=1)
+			#  ties are broken on j first and then on the lowest k
+			candidates = flatnonzero(best_P == best_P.max())
+			Q1 = candidates[best_j[candidates].argmax()]
+			Q0 = best_j[Q1]
 			return [Q0,Q1]
 		#  initialize first row w. beam
-		v0 = array([a[k, model.S0_Q, model.S1_Q] \
-					* b[k, observations[0]] for k in range(N_STATES)])
-		threshold = max(v0) * BEAM_C
-		beam_j = [j for j in range(N_STATES) if v0[j] >= threshold]
+		v0 = mul(a[:, model.S0_Q, model.S1_Q], b[0])
+		threshold = mul(v0.max(), BEAM_M)
+		beam_j = _top(flatnonzero(v0 >= threshold), v0, BEAM_K)
 		#  initialize second row w. beam
-		vt = zeros((N_STATES, N_STATES))
-		for k in range(N_STATES):
-			for j in beam_j:
-				vt[k, j] = a[k, model.S1_Q, j] * v0[j] \
-							* b[k, observations[1]]
-		threshold = max([max(vt[k]) for k in range(N_STATES)]) * BEAM_C
-		beam_k = [k for k in range(N_STATES) \
-						if not max(vt[k]) < threshold]
+		vt = full((N_STATES, N_STATES), ZERO)
+		vt[:, beam_j] = mul(mul(a[:, model.S1_Q, beam_j], v0[beam_j]), 
+							b[1][:, newaxis])
+		threshold = mul(vt.max(), BEAM_M)
+		beam_k = _top(flatnonzero(~(vt.max(axis=1) < threshold)), 
+					  vt.max(axis=1), BEAM_K)
+		#  bt[t, k, j] is the best i before j, k at t, t + 1, only set
+		#  for j in the beam
+		bt = self._backpointer_array((T, N_STATES, N_STATES), N_STATES)
+		stats['cells'] += N_STATES + N_STATES * len(beam_j)
+		stats['columns'] += 2
+		stats['beam_sum'] += len(beam_j) + len(beam_k)
+		stats['beam_max'] = max(stats['beam_max'], len(beam_j), len(beam_k))
 			
 		#  recursive step
 		for t in range(2, T + 1, 1):
 			beam_i = beam_j
 			beam_j = beam_k
 			v0 = vt
-			vt = zeros((N_STATES, N_STATES))
-			#  i, j, k represent states in a trigram under consideration
-			for k in range(N_STATES):
-				for j in beam_j:
-					i_list = [] #  list of viterbi values per i, j, k
-					for i in beam_i:
-						if t < T : i_list.append((a[k,i,j] \
-											* v0[j, i] \
-											* b[k, observations[t]], i))
-						else: i_list.append((a[k,i,j] * v0[j, i] \
-											 * b[k, model.END_E], i))
-					best_P, best_i = max(i_list)
-					vt[k, j] = best_P
-					#  set backtracing values
-					if k == 0: bt[t - 1, j] = zeros((N_STATES))
-					bt[t - 1, j][k] = best_i
-				if t == T:
-					bt[t, k] = vt[k].argmax()
-			threshold = max([max(vt[k]) for k in range(N_STATES)]) \
-						  * BEAM_C
-			beam_k = [k for k in range(N_STATES) \
-						if not max(vt[k]) < threshold]
+			vt = full((N_STATES, N_STATES), ZERO)
+			#  i, j, k represent states in a trigram under consideration,
+			#  P_kji[k, j, i] is the viterbi value per i, j, k
+			a_kji = a[:, beam_i][:, :, beam_j].transpose(0, 2, 1)
+			P_kji = mul(mul(a_kji, v0[ix_(beam_j, beam_i)]), 
+						b[t][:, newaxis, newaxis])
+			#  ties are broken in favour of the highest i
+			best_i = len(beam_i) - 1 - P_kji[:, :, ::-1].argmax(axis=2)
+			vt[:, beam_j] = P_kji.max(axis=2)
+			#  set backtracing values
+			bt[t - 1][:, beam_j] = beam_i[best_i]
+			threshold = mul(vt.max(), BEAM_M)
+			beam_k = _top(flatnonzero(~(vt.max(axis=1) < threshold)), 
+						  vt.max(axis=1), BEAM_K)
+			stats['cells'] += P_kji.size
+			if t < T:
+				stats['columns'] += 1
+				stats['beam_sum'] += len(beam_k)
+				stats['beam_max'] = max(stats['beam_max'], len(beam_k))
 		#  initialize backtracing
 		path = deque()
 		path.appendleft(model.END_Q)
-		j = bt[T, model.END_Q]
+		j = int(vt[model.END_Q].argmax())
 		#  recursive step
 		for t in range(T - 1, 0, -1):
 			path.appendleft(j)
-			j = int(bt[t, j][path[1]])
+			j = int(bt[t, path[1], j])
+			assert j >= 0, "backpointer outside the beam"
 		# terminate and remove 'END' node at the end of path
 		path.appendleft(j)
 		path.pop() 
 		
 		return path
 	
+	def viterbi_batch(self, sentences, model, log_space=False, 
+					  observations=None):
+		"""Find optimal hidden paths for a list of token lists at once
+		
+		Sentences are grouped into buckets of equal length and each 
+		bucket runs the recursion of viterbi() on arrays with an extra
+		sentence axis. Beams are kept per sentence as boolean masks over
+		the states, so every path is identical to the one viterbi() 
+		finds for the same sentence. Sentences shorter than three tokens
+		are handed to viterbi() directly. A bucket only evaluates the 
+		cells within the beams of each sentence, the same cells as 
+		viterbi(), and adds the same counts to model.pruning.
+		
+		arguments: 
+			sentences (list): a list of token lists
+			model (Model): the model supplies transition and emission
+				probabilities as well as symbol language
+			log_space (bool): decode with log Ps instead of Ps
+			observations (list): emission ints of every sentence, as 
+				in viterbi(). sentences may then be None
+		
+		Returns a list with one deque of states per sentence"""
+		MAX_CELLS = 1 << 22 #  limit on batch size * N_STATES ** 3, the 
+		#  cells of a step when every beam holds all states
+		N_STATES = model.get_state_N()
+		B_MAX = max(1, MAX_CELLS // N_STATES ** 3)
+		check_beam(model.beam, model.beam_width)
+		if observations is None:
+			observations = [model.converter.convert_tokens(*token_list) 
+								for token_list in sentences]
+		if sentences is None: 
+			sentences = [[None] * len(obs) for obs in observations]
+		paths = [None] * len(sentences)
+		buckets = dict()
+		for n, token_list in enumerate(sentences):
+			if len(token_list) < 3:
+				paths[n] = self.viterbi(token_list, model, log_space, 
+										observations[n])
+			else:
+				buckets.setdefault(len(token_list), []).append(n)
+		for T, bucket in buckets.items():
+			for start in range(0, len(bucket), B_MAX):
+				batch = bucket[start:start + B_MAX]
+				found = self._viterbi_bucket([sentences[n] for n in batch],
+											 [observations[n] for n in batch],
+											 model, log_space)
+				for n, path in zip(batch, found):
+					paths[n] = path
+		return paths
+	
+	def _viterbi_bucket(self, sentences, observations, model, log_space):
+		"""Runs viterbi recursion over sentences of equal length >= 3
+		
+		Arrays carry the sentence on their first axis. Beams are masks, 
+		and each step only evaluates the triples of states i, j, k with 
+		i and j in the beams of their sentence, laid out one after the 
+		other, so the cells are exactly those viterbi() evaluates and 
+		ties are broken as it does.
+		
+		Returns a list of deques with the most likely state paths"""
+		B, T, N_STATES = len(sentences), len(sentences[0]), \
+							model.get_state_N()
+		#  beam search threshold constant and maximum beam width
+		BEAM_C, BEAM_K = model.beam, model.beam_width
+		stats = model.pruning
+		stats['sentences'] += B
+		stats['tokens'] += B * T
+		if log_space:
+			mul, ZERO, BEAM_M = add, -inf, log(BEAM_C)
+			column = model.emissions.log_column
+		else:
+			mul, ZERO, BEAM_M = multiply, 0.0, BEAM_C
+			column = model.emissions.column
+		a = model.get_transition_array(log_space)
+		#  b[n, t] holds the state column of token t in sentence n
+		b = empty((B, T + 1, N_STATES))
+		for n, token_list in enumerate(sentences):
+			for t, e in enumerate(observations[n]):
+				b[n, t] = column(e, N_STATES, token_list[t])
+			b[n, T] = column(model.END_E, N_STATES)
+		#  bt[n, t, k, j] is the best i before j, k at t, t + 1, only 
+		#  set for j in the beam of sentence n
+		bt = self._backpointer_array((B, T, N_STATES, N_STATES), N_STATES)
+		#  initialize first row w. beam
+		v0 = mul(a[:, model.S0_Q, model.S1_Q], b[:, 0])
+		threshold = mul(v0.max(axis=1), BEAM_M)
+		beam_j = _top_mask(v0 >= threshold[:, newaxis], v0, BEAM_K)
+		#  initialize second row w. beam
+		vt = where(beam_j[:, newaxis, :], 
+				   mul(mul(a[:, model.S1_Q, :], v0[:, newaxis, :]), 
+					   b[:, 1, :, newaxis]), ZERO)
+		threshold = mul(vt.max(axis=(1, 2)), BEAM_M)
+		beam_k = _top_mask(~(vt.max(axis=2) < threshold[:, newaxis]), 
+						   vt.max(axis=2), BEAM_K)
+		sizes = concatenate((beam_j.sum(axis=1), beam_k.sum(axis=1)))
+		stats['cells'] += B * N_STATES + N_STATES * int(sizes[:B].sum())
+		
+		#  recursive step
+		for t in range(2, T + 1, 1):
+			beam_i = beam_j
+			beam_j = beam_k
+			v0 = vt
+			#  the triples n, j, i of sentences and their beam states, 
+			#  sorted so that every n, j is a group of ascending i
+			pair_n, pair_j, pair_i = nonzero(beam_j[:, :, newaxis] 
+											 & beam_i[:, newaxis, :])
+			is_start = concatenate(([True], (pair_n[1:] != pair_n[:-1]) 
+										  | (pair_j[1:] != pair_j[:-1])))
+			starts, group = flatnonzero(is_start), cumsum(is_start) - 1
+			#  P_kp[k, p] is the viterbi value per k and triple p
+			P_kp = mul(mul(a[:, pair_i, pair_j], v0[pair_n, pair_j, pair_i]), 
+					   b[pair_n, t].T)
+			best_P = maximum.reduceat(P_kp, starts, axis=1)
+			#  ties are broken in favour of the highest i
+			best_p = maximum.reduceat(where(P_kp == best_P[:, group], 
+											arange(len(pair_n)), -1), 
+									  starts, axis=1)
+			group_n, group_j = pair_n[starts], pair_j[starts]
+			vt = full((B, N_STATES, N_STATES), ZERO)
+			vt[group_n, :, group_j] = best_P.T
+			#  set backtracing values
+			bt[group_n, t - 1, :, group_j] = pair_i[best_p].T
+			threshold = mul(vt.max(axis=(1, 2)), BEAM_M)
+			beam_k = _top_mask(~(vt.max(axis=2) < threshold[:, newaxis]), 
+							   vt.max(axis=2), BEAM_K)
+			stats['cells'] += P_kp.size
+			if t < T: sizes = concatenate((sizes, beam_k.sum(axis=1)))
+		stats['columns'] += len(sizes)
+		stats['beam_sum'] += int(sizes.sum())
+		stats['beam_max'] = max(stats['beam_max'], int(sizes.max()))
+		last_j = vt.argmax(axis=2)
+		#  backtracing per sentence
+		paths = []
+		for n in range(B):
+			path = deque()
+			path.appendleft(model.END_Q)
+			j = int(last_j[n, model.END_Q])
+			for t in range(T - 1, 0, -1):
+				path.appendleft(j)
+				j = int(bt[n, t, path[1], j])
+				assert j >= 0, "backpointer outside the beam"
+			path.appendleft(j)
+			path.pop()
+			paths.append(path)
+		return paths
+	
 	@staticmethod
 	def test():
+		from model import Model
 		test_sentence = "Det här är en testmening ."
 		testfile = "pos_model.pickle"
 		hmm = HMM()
@@ -150,79 +385,11 @@ class HMM:
 		t0 = time()
 		#print(*hmm.viterbi(test_sentence.split(), model))
 		print(model.converter.decode_tags(*hmm.viterbi(test_sentence.split(), model)))
-		t = t0 - time()
+		t = time() - t0
 		print(t)
-	
-	@staticmethod
-	def test_POS_UD(filename, filesize):
-		testmodel = "pos_model_UD_en.pickle"
-		hmm = HMM()
-		parser = ConllParser()
-		model = Model()
-		model.load_from(testmodel)
-		correct_n, total_n, line_n, progress = 0, 0, 0, 0
-		with open(filename, 'r') as inf:
-			sentence, tags = [], []
-			line = inf.readline()
-			while line:
-				if line != "\n":
-					token, tag, a = parser.parse_line_POS(line)
-					sentence.append(token)
-					tags.append(model.converter.convert_state(tag))
-				else:
-					if len(sentence) > 0:
-						guesses = hmm.viterbi(sentence, model)
-						for i in range(len(sentence)):
-							if tags[i] == guesses[i]: correct_n += 1
-							total_n += 1
-						sentence, tags = [], []
-						progress_value = int(line_n * 100 / filesize) % 10
-						if progress_value > progress:
-							progress = progress_value
-							print( str(progress*10)+"%")
-							print("Accuracy:", correct_n / float(total_n))
-				line = inf.readline()
-				line_n += 1
-			print("Final accuracy:", correct_n / float(total_n))
-		
-	@staticmethod
-	def test_CHUNK_UD(filename, filesize):
-		testmodel = "chunk_model_UD_en.pickle"
-		hmm = HMM()
-		parser = ConllParser()
-		model = Model()
-		model.load_from(testmodel)
-		correct_n, total_n, line_n, progress = 0, 0, 0, 0
-		with open(filename, 'r') as inf:
-			sentence, tags = [], []
-			line = inf.readline()
-			while line:
-				if line != "\n":
-					token, tag = parser.parse_line_CHUNK(line)
-					sentence.append(token)
-					tags.append(model.converter.convert_state(tag))
-				else:
-					if len(sentence) > 0:
-						guesses = hmm.viterbi(sentence, model)
-						for i in range(len(sentence)):
-							if tags[i] == guesses[i]: correct_n += 1
-							total_n += 1
-						sentence, tags = [], []
-						progress_value =  int(line_n * 100 / filesize / 10)
-						if progress_value > progress:
-							progress = progress_value
-							print( str(progress*10)+"%")
-							print("Accuracy:", correct_n / float(total_n))
-				line_n += 1
-				line = inf.readline()
-		print("Final accuracy:", correct_n / float(total_n))
-					
-		
 
 if __name__ == '__main__':
 	#Converter.test()
 	#TransitionHandler.test()
 	#EmissionHandler.test()
-	#HMM.test_POS_UD("/home/peterpersson/lin503/projekt/universal_treebanks_v1.0/en-universal-test.conll", 59100)
-	HMM.test_CHUNK_UD("/home/peterpersson/lin503/projekt/universal_treebanks_v1.0/en-universal-test.conll", 59100)
-	#HMM.test()
+	HMM.test()
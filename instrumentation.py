@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  instrumentation.py
+#
+#  Copyright 2015 Peter Persson <peter.johan.persson@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from time import perf_counter
+from collections import Counter
+
+class Stats:
+	"""Wall time per stage and event counters of a tagging run
+
+	Code that is instrumented keeps a reference to a Stats object, or
+	None when instrumentation is off, and only reads the clock when it
+	has one. Turned off, instrumentation thus costs one test of None
+	per sentence. Stages are named by the code that times them: load,
+	read, pos, oov, chunk and write for the Chunker. oov is the part of
+	pos spent estimating unknown tokens.
+
+	attributes:
+		start (float): perf_counter() time at which the run started
+		seconds (Counter): wall time spent in each stage
+		counts (Counter): number of sentences, tokens, oov_tokens, ...
+
+	methods:
+		lap(stage, start): adds time since start to stage
+		add(data): adds seconds and counts of a dict from as_dict
+		as_dict(): returns seconds and counts as plain dict
+		clear(): resets seconds and counts, but not start
+		summary([caches]): returns report of the run as dict"""
+	def __init__(self):
+		self.start = perf_counter()
+		self.seconds = Counter()
+		self.counts = Counter()
+
+	def lap(self, stage, start):
+		"""Adds time since start to stage and returns the current time"""
+		now = perf_counter()
+		self.seconds[stage] += now - start
+		return now
+
+	def add(self, data):
+		self.seconds.update(data['seconds'])
+		self.counts.update(data['counts'])
+
+	def as_dict(self):
+		return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+	def clear(self):
+		self.seconds.clear()
+		self.counts.clear()
+
+	def summary(self, caches=None):
+		"""Returns report of the run as dict
+
+		The report holds the wall time since start, the counts, tokens
+		per second, the share of tokens that were out of vocabulary and
+		the seconds and share of the wall time of every stage. caches
+		is an optional dict of cache statistics to include by name."""
+		wall = perf_counter() - self.start
+		tokens = self.counts['tokens']
+		report = {'wall_seconds': wall, 'counts': dict(self.counts),
+				  'tokens_per_sec': tokens / wall if wall else 0.0,
+				  'oov_rate': self.counts['oov_tokens'] / tokens
+								if tokens else 0.0,
+				  'stages': {stage: {'seconds': seconds,
+									 'share': seconds / wall if wall else 0.0}
+								for stage, seconds in self.seconds.items()}}
+		if caches: report['caches'] = caches
+		return report
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  lrucache.py
+#  
+#  Copyright 2015 Peter Persson <peter.johan.persson@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+class LRUCache(MutableMapping):
+	"""dict-like cache of bounded size that evicts least recently used
+	
+	Every lookup counts as a hit or a miss, and every entry pushed out 
+	to make room for a new one counts as an eviction. A maxsize of 0 
+	turns the cache off, nothing is then stored.
+	
+	attributes:
+		data (OrderedDict): cached entries, least recently used first
+		maxsize (int): largest number of entries kept
+		hits (int): number of lookups that found their key
+		misses (int): number of lookups that did not
+		evictions (int): number of entries evicted
+	
+	methods:
+		__getitem__(key): returns cached value, marking it as used
+		__setitem__(key, value): caches value, evicting if full
+		stats(): returns size and counters as dict"""
+	def __init__(self, maxsize=10000):
+		self.data = OrderedDict()
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def __getitem__(self, key):
+		try:
+			value = self.data[key]
+		except KeyError:
+			self.misses += 1
+			raise
+		self.hits += 1
+		self.data.move_to_end(key)
+		return value
+	
+	def __setitem__(self, key, value):
+		if self.maxsize <= 0: return
+		self.data[key] = value
+		self.data.move_to_end(key)
+		while len(self.data) > self.maxsize:
+			self.data.popitem(last=False)
+			self.evictions += 1
+	
+	def __delitem__(self, key):
+		del self.data[key]
+	
+	def __contains__(self, key):
+		return key in self.data
+	
+	def __iter__(self):
+		return iter(self.data)
+	
+	def __len__(self):
+		return len(self.data)
+	
+	def stats(self):
+		"""Returns size, maxsize, hits, misses and evictions as dict"""
+		return {'size': len(self.data), 'maxsize': self.maxsize, 
+				'hits': self.hits, 'misses': self.misses, 
+				'evictions': self.evictions}
@@ -24,14 +24,138 @@
 
 from numpy import *
 import pickle
+import json
+import struct
 from converter import Converter
+from hmm import check_beam
 from estimation import TransitionHandler, EmissionHandler
-from textutils import ConllParser
+from textutils import ConllParser, ConllReader
+from lrucache import LRUCache
 from collections import Counter
 
 CHUNK = 0
 POS = 1
 
+#  binary model format, see Model.save_at
+BINARY_MAGIC = b'HMMMODEL'
+BINARY_VERSION = 1
+BINARY_ALIGN = 64
+
+def _aligned(n):
+	"""Rounds n up to a multiple of BINARY_ALIGN"""
+	return -(-n // BINARY_ALIGN) * BINARY_ALIGN
+
+def _pack_symbols(symbols):
+	"""Returns newline separated UTF-8 bytes of symbols as uint8 array"""
+	return frombuffer("\n".join(symbols).encode('utf-8'), dtype=uint8)
+
+def _unpack_symbols(data):
+	"""Returns list of symbols packed by _pack_symbols"""
+	return bytes(data).decode('utf-8').split("\n")
+
+def _read_header(read):
+	"""Returns JSON header and start of the arrays of a binary model
+	
+	read(offset, n) returns n bytes of the model from offset."""
+	if read(0, len(BINARY_MAGIC)) != BINARY_MAGIC:
+		raise ValueError("Not a binary model")
+	version, header_N = struct.unpack('<II', read(len(BINARY_MAGIC), 8))
+	if version > BINARY_VERSION:
+		raise ValueError("Unsupported model format version " + str(version))
+	header = json.loads(read(len(BINARY_MAGIC) + 8, header_N).decode('utf-8'))
+	return header, _aligned(len(BINARY_MAGIC) + 8 + header_N)
+
+#  shared memory blocks used by this process, by name, each as a list of
+#  the SharedMemory, its number of references and whether it was created
+#  here, see Model.share and Model.attach
+_shared_blocks = {}
+
+def _acquire_shared(name, size=0):
+	"""Returns shared memory block name, adding a reference to it
+	
+	A new block of size bytes is created, and owned by this process, if
+	size is given. Blocks created by another process are not destroyed 
+	by the resource tracker of this one when it exits, unless that 
+	tracker is shared with the creator, as with multiprocessing."""
+	from multiprocessing import shared_memory, resource_tracker, \
+								parent_process
+	if size:
+		block = shared_memory.SharedMemory(create=True, size=size)
+		_shared_blocks[block.name] = [block, 1, True]
+		return block
+	if name in _shared_blocks:
+		_shared_blocks[name][1] += 1
+		return _shared_blocks[name][0]
+	block = shared_memory.SharedMemory(name)
+	if parent_process() is None:
+		resource_tracker.unregister(block._name, 'shared_memory')
+	_shared_blocks[name] = [block, 1, False]
+	return block
+
+def release_shared(name):
+	"""Drops a reference to shared memory block name of this process
+	
+	When the last reference is dropped the block is closed, and 
+	destroyed if it was created by this process. Its memory is freed 
+	once no process maps it, arrays still viewing it keep it mapped."""
+	entry = _shared_blocks[name]
+	entry[1] -= 1
+	if entry[1] > 0: return
+	del _shared_blocks[name]
+	block, refs, owner = entry
+	if owner: block.unlink()
+	try:
+		block.close()
+	except BufferError:
+		pass
+
+def _new_counts():
+	"""Returns empty frequency counts used by Model during training"""
+	return {'trigrams': Counter(), 'bigrams': Counter(), 
+			'unigrams': Counter(), 'Q_counts': Counter(), 
+			'S_counts': Counter(), 'Q_S_counts': Counter(), 'token_N': 0}
+
+def _split_at_sentences(filename, shard_N):
+	"""Returns (start, end) byte offsets of about shard_N equal shards
+	
+	Every shard but the first starts right after a blank line, so no 
+	sentence is split between shards."""
+	bounds = [0]
+	with open(filename, 'rb') as inf:
+		size = inf.seek(0, 2)
+		for n in range(1, shard_N):
+			inf.seek(max(size * n // shard_N, bounds[-1]))
+			inf.readline() #  skip the rest of a partly read line
+			line = inf.readline()
+			while line and line.strip(b"\r\n"):
+				line = inf.readline()
+			if inf.tell() >= size: break
+			bounds.append(inf.tell())
+	bounds.append(size)
+	return list(zip(bounds[:-1], bounds[1:]))
+
+def _columns(mode):
+	"""Returns the emission and state columns read for mode"""
+	if mode == POS: return ConllParser.TOKEN, ConllParser.TAG
+	return ConllParser.TAG, ConllParser.CHUNK
+
+def _count_shard(args):
+	"""Counts the lines of a shard of a conll file in a worker process
+	
+	Returns the states and emissions in the order the shard learned 
+	them, the state/emission pair frequencies and the other counts."""
+	filename, start, end, mode = args
+	model = Model()
+	model.converter = Converter()
+	model.emissions = EmissionHandler(model.converter)
+	model.conll = ConllParser()
+	model._define_symbols()
+	counts = _new_counts()
+	with ConllReader(filename, start, end) as reader:
+		model._count(reader.sentences(*_columns(mode)), mode, counts)
+	return (model.converter.get_states(), model.converter.get_emissions(),
+			model.emissions.data, counts)
+
 class Model():
 	"""Handles emission and transition probabilities and training
 	
@@ -53,132 +177,458 @@ class Model():
 		S1_E (int): int name of second start emission symbol
 		END_E (int): int name of end emission symbol
 		
+		beam (float): states of a column whose value is less than beam
+			times the best are pruned from the beam when decoding
+		beam_width (int): most states kept in the beam, 0 for no limit,
+			beam and beam_width out of range raise ValueError
+		pruning (dict): beam sizes and trellis cells evaluated when 
+			decoding with the model, see pruning_stats()
+		shared (string): name of the shared memory block the model is
+			attached to, or None
+		
 	methods:
+		pruning_stats(): returns summary of decoding with the model
+		reset_pruning_stats(): clears counts of the pruning attribute
 		get_state_N(): returns number of states in model
 		get_emission_N(): returns number of emissions in model
-		train(filename, mode): train model from conll file at filename
-		save_at(filename): pickle dump to filename
-		load_from(filename): unpickle from filename
+		get_transition_array([log_space]): returns dense array of 
+			transition Ps, or log Ps if log_space is set
+		train(filename[, mode, workers]): train model from conll file 
+			at filename, counting it with workers processes
+		update(filename[, mode, workers]): add the data of conll file 
+			at filename to a trained model
+		freeze([cache_size]): prepare model for long running inference
+		save_at(filename[, binary]): pickle dump, or write in binary 
+			format, to filename
+		load_from(filename): unpickle, or memory map binary format, 
+			from filename
+		share([log_space]): publish in shared memory, returns the name
+			of the block
+		attach(name): load from shared memory block name, read-only
+		detach(): release the block of an attached model
 	"""
+	def __init__(self, beam=1/1000, beam_width=0):
+		check_beam(beam, beam_width)
+		self.beam = beam
+		self.beam_width = beam_width
+		self.shared = None
+		self.reset_pruning_stats()
+	
+	def reset_pruning_stats(self):
+		self.pruning = {'sentences': 0, 'tokens': 0, 'columns': 0, 
+						'beam_sum': 0, 'beam_max': 0, 'cells': 0}
+	
+	def pruning_stats(self):
+		"""Summarizes the pruning attribute
+		
+		Returns dict with numbers of sentences and tokens decoded, mean
+		and max number of states in the beam of a trellis column, and 
+		mean number of trellis cells evaluated per token"""
+		stats = self.pruning
+		return {'sentences': stats['sentences'], 'tokens': stats['tokens'],
+				'beam': self.beam, 'beam_width': self.beam_width,
+				'beam_mean': stats['beam_sum'] / max(stats['columns'], 1),
+				'beam_max': stats['beam_max'], 
+				'cells_per_token': stats['cells'] / max(stats['tokens'], 1)}
+	
 	def get_state_N(self):
 		return self.converter.get_state_N()
 		
 	def get_emission_N(self):
 		return self.converter.get_emission_N()
 	
-	def train(self, filename, mode=POS):
+	def get_transition_array(self, log_space=False):
+		"""Returns transition Ps (or log Ps) as array indexed [k, i, j]"""
+		return self.transitions.get_array(log_space)
+	
+	def train(self, filename, mode=POS, workers=1):
 		"""Learns probabilities and symbol names from conll file
 		
 		Reads data from conll file at filename and trains a Converter
 		object, a TransitionHandler object and an Emission handler 
 		object from the data. Also defines start and end symbols.
 		
+		With more than one worker the file is split at sentence 
+		boundaries into one shard per worker. Each shard is counted in 
+		a worker process and the counts are merged in file order, which
+		gives the same model as counting the file in one process.
+		
 		arguments:
 			filename (string): the conll file to learn from
 			mode (int): should be CHUNK or POS depending on model type
 				to be trained
+			workers (int): number of processes counting the file
 		"""
-		#  E for emission, Q for state, S for suffix
-		E, Q, S, BLANK = 0, 1, 2, "\n"
 		#  clear/init model
 		self.converter = Converter()
 		self.transitions = TransitionHandler()
 		self.emissions = EmissionHandler(self.converter)
 		self.conll = ConllParser()
+		self._define_symbols()
 		#  define metrics
-		token_N = 0
-		state_N = 0
-		trigrams = Counter()
-		bigrams = Counter()
-		unigrams = Counter()
-		S_counts = Counter()
-		Q_counts = Counter()
-		Q_S_counts = Counter()
-		#  defining special symbols
+		counts = _new_counts()
+		#  add special symbols to uni- and bigrams and set emissions
+		counts['unigrams'][self.S0_Q] += 1
+		counts['unigrams'][self.S1_Q] += 1
+		counts['bigrams'][self.S0_Q, self.S1_Q] += 1
+		self.emissions.add((self.END_Q, self.END_E))
+		self.emissions.add((self.S0_Q, self.S0_E))
+		self.emissions.add((self.S1_Q, self.S1_E))
+		self._read(filename, mode, counts, workers)
+		self._estimate(mode, counts)
+	
+	def update(self, filename, mode=POS, workers=1):
+		"""Learns from the data of another conll file
+		
+		Adds the frequencies in the conll file at filename to the raw 
+		counts kept by the handlers of a trained model, and new symbols
+		to the converter. Then the lambdas, theta, emission Ps, suffix 
+		table and transition array are computed again from the counts.
+		Reading the file is the only step that depends on the size of 
+		the new data, the rest depends on the number of distinct 
+		symbols and n-grams. The result is the same as training on the 
+		old data followed by the new. A frozen model stays frozen. 
+		Tokens that an unfrozen model learned while tagging are 
+		forgotten first, they have no counts.
+		
+		Binary models do not keep raw counts and cannot be updated.
+		
+		arguments:
+			filename (string): the conll file to learn from
+			mode (int): should be CHUNK or POS, as when trained
+			workers (int): number of processes counting the file
+		"""
+		if not self.emissions.data:
+			raise ValueError("Model has no training counts to update")
+		frozen = self.converter.frozen
+		if frozen:
+			cache_size = self.emissions.oov_cache.maxsize
+			self.converter.freeze(False)
+		self.converter.forget_emissions(self.emissions.emission_N)
+		self.conll = ConllParser()
+		counts = {'trigrams': self.transitions.trigrams, 
+				  'bigrams': self.transitions.bigrams, 
+				  'unigrams': self.transitions.unigrams, 
+				  'Q_counts': self.emissions.Q_counts, 
+				  'S_counts': self.emissions.S_counts, 
+				  'Q_S_counts': self.emissions.Q_S_counts, 
+				  'token_N': self.transitions.token_N}
+		self._read(filename, mode, counts, workers)
+		self._estimate(mode, counts)
+		self.emissions.oov_cache = LRUCache(self.emissions.oov_cache.maxsize)
+		if frozen: self.freeze(cache_size)
+	
+	def _read(self, filename, mode, counts, workers):
+		"""Counts conll file at filename, in workers processes if > 1"""
+		if workers > 1:
+			from multiprocessing import Pool
+			shards = [(filename, start, end, mode) for start, end 
+						in _split_at_sentences(filename, workers)]
+			with Pool(min(workers, len(shards))) as pool:
+				for shard in pool.imap(_count_shard, shards):
+					self._merge(shard, counts)
+		else:
+			with ConllReader(filename) as reader:
+				self._count(reader.sentences(*_columns(mode)), mode, counts)
+	
+	def _estimate(self, mode, counts):
+		"""Normalizes found emissions and trains estimations from counts"""
+		state_N = self.converter.get_state_N()
+		emission_N = self.converter.get_emission_N()
+		self.emissions.normalize(state_N, emission_N)
+		if mode == POS: 
+			self.emissions.train(counts['Q_counts'], counts['S_counts'], 
+								 counts['Q_S_counts'], counts['token_N'])
+		self.transitions.train(counts['unigrams'], counts['bigrams'], 
+							   counts['trigrams'], counts['token_N'])
+		self.transitions.materialize(state_N)
+	
+	def _define_symbols(self):
+		"""Gives the start and end symbols the first int names"""
 		self.S0_Q = self.converter.convert_state('S0')
 		self.S1_Q = self.converter.convert_state('S1')
 		self.S0_E = self.converter.convert_emission('S0')
 		self.S1_E = self.converter.convert_emission('S1')
 		self.END_Q = self.converter.convert_state('END')
 		self.END_E = self.converter.convert_emission('END')
-		#  add them to uni- and bigrams and set emissions
-		unigrams[self.S0_Q] += 1; unigrams[self.S1_Q] += 1
-		bigrams[self.S0_Q, self.S1_Q] += 1
-		self.emissions.add((self.END_Q, self.END_E))
-		self.emissions.add((self.S0_Q, self.S0_E))
-		self.emissions.add((self.S1_Q, self.S1_E))
-		#  read data from file
-		with open(filename, 'r') as inf:
+	
+	def _count(self, sentences, mode, counts):
+		"""Adds symbols and frequencies of sentences to the model
+		
+		sentences generates (emissions, states) lists, see _columns. 
+		Symbols are learned by the converter and state/emission pairs 
+		are added to the emission handler, the other frequencies are 
+		added to the Counters in counts (see _new_counts)."""
+		#  Q for state
+		Q = 1
+		trigrams, bigrams = counts['trigrams'], counts['bigrams']
+		unigrams, Q_counts = counts['unigrams'], counts['Q_counts']
+		S_counts, Q_S_counts = counts['S_counts'], counts['Q_S_counts']
+		for emissions, states in sentences:
 			sentence = []
-			line = inf.readline()
-			while line:
-				if line != BLANK:
-					if mode == POS: 
-						entry = self.conll.parse_line_POS(line)
-					else: entry = self.conll.parse_line_CHUNK(line)
-					#  convert/learn int names
-					q = self.converter.convert_state(entry[Q]) 
-					e = self.converter.convert_emission(entry[E])
-					#  counts for emission
-					self.emissions.add((q,e))
-					if mode == POS:
-						Q_counts[q] += 1
-						for s in entry[S]:
-							S_counts[s] += 1
-							Q_S_counts[q, s] += 1
-					#  uni-, bi-, and trigram counts for transition
-					if len(sentence) == 0:
-						trigrams[self.S0_Q, self.S1_Q, q] += 1
-						bigrams[self.S1_Q, q] += 1
-						unigrams[q] += 1
-					elif len(sentence) == 1:
-						trigrams[self.S1_Q, sentence[-1][Q], q] += 1
-						bigrams[sentence[-1][Q], q] += 1
-						unigrams[q] += 1
-					else:
-						trigrams[sentence[-2][Q], sentence[-1][Q], q] += 1
-						bigrams[sentence[-1][Q], q] += 1
-						unigrams[q] += 1
-					#  loop update
-					sentence.append((q,e))
-					token_N += 1
+			for token, tag in zip(emissions, states):
+				#  convert/learn int names
+				q = self.converter.convert_state(tag) 
+				e = self.converter.convert_emission(token)
+				#  counts for emission
+				self.emissions.add((q,e))
+				if mode == POS:
+					Q_counts[q] += 1
+					for s in self.conll.find_suffixes(token):
+						S_counts[s] += 1
+						Q_S_counts[q, s] += 1
+				#  uni-, bi-, and trigram counts for transition
+				if len(sentence) == 0:
+					trigrams[self.S0_Q, self.S1_Q, q] += 1
+					bigrams[self.S1_Q, q] += 1
+					unigrams[q] += 1
+				elif len(sentence) == 1:
+					trigrams[self.S1_Q, sentence[-1][Q], q] += 1
+					bigrams[sentence[-1][Q], q] += 1
+					unigrams[q] += 1
 				else:
-					#  blank line means end of sentence
-					if len(sentence)>= 2: 
-						trigrams[sentence[-2][Q], sentence[-1][Q], self.END_Q] += 1
-					if len(sentence)>= 1: 
-						bigrams[sentence[-1][Q], self.END_Q] += 1
-					if len(sentence) > 0: 
-						unigrams[self.END_Q] += 1
-						Q_counts[self.END_Q] += 1
-						Q_counts[self.S0_Q] += 1
-						Q_counts[self.S1_Q] += 1
-					#  loop update
-					sentence = []
-				line = inf.readline()
-		#  normalize found emissions and train estimations
-		state_N = self.converter.get_state_N()
-		emission_N = self.converter.get_emission_N()
-		self.emissions.normalize(state_N, emission_N)
-		if mode == POS: 
-			self.emissions.train(Q_counts, S_counts, Q_S_counts, token_N)
-		self.transitions.train(unigrams, bigrams, trigrams, token_N)
+					trigrams[sentence[-2][Q], sentence[-1][Q], q] += 1
+					bigrams[sentence[-1][Q], q] += 1
+					unigrams[q] += 1
+				#  loop update
+				sentence.append((q,e))
+				counts['token_N'] += 1
+			#  end of sentence
+			if len(sentence)>= 2: 
+				trigrams[sentence[-2][Q], sentence[-1][Q], self.END_Q] += 1
+			bigrams[sentence[-1][Q], self.END_Q] += 1
+			unigrams[self.END_Q] += 1
+			Q_counts[self.END_Q] += 1
+			Q_counts[self.S0_Q] += 1
+			Q_counts[self.S1_Q] += 1
+	
+	def _merge(self, shard, counts):
+		"""Adds the symbols and counts of a shard to the model
+		
+		shard is returned by _count_shard and has its own int names. 
+		Its symbols are converted in the order the shard learned them, 
+		and its counts are added in the order they were first counted, 
+		so merging shards in file order learns the same int names and 
+		orders the Counters the same as counting the whole file. Like 
+		in _count, the earlier positions of n-gram keys hold the ints 
+		of the emissions at those positions."""
+		states, emissions, pairs, shard_counts = shard
+		Q = self.converter.convert_tags(*states)
+		E = self.converter.convert_tokens(*emissions)
+		for (q, e), n in pairs.items():
+			self.emissions.data[Q[q], E[e]] += n
+		for q, n in shard_counts['unigrams'].items():
+			counts['unigrams'][Q[q]] += n
+		for (j, q), n in shard_counts['bigrams'].items():
+			counts['bigrams'][E[j], Q[q]] += n
+		for (i, j, q), n in shard_counts['trigrams'].items():
+			counts['trigrams'][E[i], E[j], Q[q]] += n
+		for q, n in shard_counts['Q_counts'].items():
+			counts['Q_counts'][Q[q]] += n
+		counts['S_counts'].update(shard_counts['S_counts'])
+		for (q, s), n in shard_counts['Q_S_counts'].items():
+			counts['Q_S_counts'][Q[q], s] += n
+		counts['token_N'] += shard_counts['token_N']
 	
-	def save_at(self, filename):
+	def freeze(self, cache_size=10000):
+		"""Prepares a trained or loaded model for long running inference
+		
+		Freezes the converter so that unknown tokens share one OOV int 
+		instead of being added to the vocabulary, and bounds the caches
+		of the transition and emission handlers to cache_size entries 
+		with least recently used eviction. The model can then tag for 
+		any length of time without growing."""
+		self.converter.freeze()
+		self.transitions.data = LRUCache(cache_size)
+		self.emissions.oov_cache = LRUCache(cache_size)
+	
+	def save_at(self, filename, binary=False):
+		"""Saves model at filename, as pickles or in binary format
+		
+		The binary format starts with BINARY_MAGIC, a format version 
+		and the length of a JSON header. The header holds the scalar 
+		attributes of the model and the dtype, shape and offset of every
+		array. The arrays follow the header as raw blocks aligned to 
+		BINARY_ALIGN bytes, so that they can be memory mapped. Symbol 
+		lists are stored as newline separated UTF-8 blocks. Raw training
+		counts are not part of the binary format."""
+		if binary: return self._save_binary(filename)
 		with open(filename, 'wb') as outf:
 			pickle.dump(self.transitions, outf)
 			pickle.dump(self.emissions, outf)
 	
 	def load_from(self, filename):
+		"""Loads model from filename, detecting its format
+		
+		Models in binary format are memory mapped, so loading is near 
+		instant and the pages of the arrays are shared by all processes
+		that load the same file. Pickled models are unpickled."""
 		with open(filename, 'rb') as inf:
-			self.transitions = pickle.load(inf)
-			self.emissions = pickle.load(inf)
-		self.converter = self.emissions.converter
-		#  relearn special symbols 
+			binary = inf.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+		if binary: 
+			self._load_binary(filename)
+		else:
+			with open(filename, 'rb') as inf:
+				self.transitions = pickle.load(inf)
+				self.emissions = pickle.load(inf)
+			self.converter = self.emissions.converter
+		self._relearn_symbols()
+		if not binary:
+			self.transitions.materialize(self.get_state_N())
+	
+	def _relearn_symbols(self):
 		self.S0_Q, self.S1_Q = self.converter.convert_tags("S0", "S1")
 		self.S0_E, self.S1_E,  = self.converter.convert_tokens("S0", "S1")
 		self.END_E, self.END_Q = self.converter.convert_both(("END","END"))[0]
 	
+	def share(self, log_space=False):
+		"""Publishes the model in a new shared memory block
+		
+		The block holds the model in the binary format of save_at, so 
+		that models in other processes can attach() to it and use its 
+		arrays without copying them. With log_space the log transition
+		and emission Ps are published too, so that attached models do 
+		not each compute their own. The block is destroyed once this 
+		process has released it with release_shared(name), or when it 
+		exits.
+		
+		Returns the name of the block as string"""
+		header, arrays = self._binary_image(log_space)
+		start = _aligned(len(BINARY_MAGIC) + 8 + len(header))
+		size = start + sum(_aligned(data.nbytes) for data in arrays.values())
+		block = _acquire_shared(None, size)
+		prefix = BINARY_MAGIC + struct.pack('<II', BINARY_VERSION, 
+											 len(header)) + header
+		block.buf[:len(prefix)] = prefix
+		info = json.loads(header.decode('utf-8'))['arrays']
+		for name, data in arrays.items():
+			if data.size == 0: continue
+			target = ndarray(data.shape, data.dtype, buffer=block.buf, 
+							 offset=start + info[name]['offset'])
+			target[...] = data
+			del target
+		return block.name
+	
+	def attach(self, name):
+		"""Loads the model published in shared memory block name
+		
+		Like load_from, but the arrays are read-only views of the block
+		instead of copies, so every process attached to a block shares 
+		its memory. Each attach holds a reference to the block in this 
+		process until detach()."""
+		block = _acquire_shared(name)
+		read = lambda offset, n: bytes(block.buf[offset:offset + n])
+		header, start = _read_header(read)
+		arrays = {}
+		for key, info in header['arrays'].items():
+			shape = tuple(info['shape'])
+			if 0 in shape:
+				arrays[key] = zeros(shape, dtype=info['dtype'])
+				continue
+			arrays[key] = ndarray(shape, info['dtype'], buffer=block.buf, 
+								  offset=start + info['offset'])
+			arrays[key].flags.writeable = False
+		self._set_arrays(header, arrays)
+		self.shared = name
+		self._relearn_symbols()
+	
+	def detach(self):
+		"""Drops the arrays of an attached model and its reference"""
+		if self.shared is None: return
+		self.transitions = TransitionHandler()
+		self.emissions = EmissionHandler(self.converter)
+		name, self.shared = self.shared, None
+		release_shared(name)
+	
+	def _binary_image(self, log_space=False):
+		"""Returns JSON header as bytes and arrays of the binary format"""
+		transitions, emissions = self.transitions, self.emissions
+		arrays = {'transitions': ascontiguousarray(transitions.array),
+				  'indptr': emissions.indptr,
+				  'states': emissions.states,
+				  'probs': emissions.probs,
+				  'state_vocab': _pack_symbols(self.converter.get_states()),
+				  'emission_vocab': 
+						_pack_symbols(self.converter.get_emissions())}
+		if emissions.suffix_table is None and emissions.Q_counts:
+			emissions.build_suffix_table()
+		if emissions.suffix_table is not None:
+			suffixes = sorted(emissions.suffix_index, 
+							  key=emissions.suffix_index.get)
+			arrays['suffix_table'] = emissions.suffix_table
+			arrays['suffix_vocab'] = _pack_symbols(suffixes)
+		if log_space:
+			arrays['log_transitions'] = ascontiguousarray(
+										transitions.get_array(True))
+			with errstate(divide='ignore'):
+				arrays['log_probs'] = log(emissions.probs)
+		header = {'lambdas': [float(l) for l in transitions.lambdas],
+				  'token_N': int(transitions.token_N),
+				  'emission_N': int(emissions.emission_N),
+				  'theta': float(getattr(emissions, 'theta', 0.0)),
+				  'arrays': {}}
+		offset = 0
+		for name, data in arrays.items():
+			header['arrays'][name] = {'dtype': data.dtype.str, 
+									  'shape': list(data.shape),
+									  'offset': offset}
+			offset += _aligned(data.nbytes)
+		return json.dumps(header).encode('utf-8'), arrays
+	
+	def _save_binary(self, filename):
+		header, arrays = self._binary_image()
+		with open(filename, 'wb') as outf:
+			outf.write(BINARY_MAGIC)
+			outf.write(struct.pack('<II', BINARY_VERSION, len(header)))
+			outf.write(header)
+			outf.write(bytes(_aligned(outf.tell()) - outf.tell()))
+			for data in arrays.values():
+				outf.write(ascontiguousarray(data).tobytes())
+				outf.write(bytes(_aligned(data.nbytes) - data.nbytes))
+	
+	def _load_binary(self, filename):
+		with open(filename, 'rb') as inf:
+			def read(offset, n):
+				inf.seek(offset)
+				return inf.read(n)
+			header, start = _read_header(read)
+		arrays = {}
+		for name, info in header['arrays'].items():
+			shape = tuple(info['shape'])
+			if 0 in shape:
+				arrays[name] = zeros(shape, dtype=info['dtype'])
+			else:
+				arrays[name] = memmap(filename, dtype=info['dtype'], 
+									  mode='r', offset=start + info['offset'], 
+									  shape=shape)
+		self._set_arrays(header, arrays)
+	
+	def _set_arrays(self, header, arrays):
+		"""Builds converter and handlers around arrays of binary format"""
+		self.converter = Converter()
+		for n, q in enumerate(_unpack_symbols(arrays['state_vocab'])):
+			self.converter.state_index[q] = n
+		for n, e in enumerate(_unpack_symbols(arrays['emission_vocab'])):
+			self.converter.emission_index[e] = n
+		self.transitions = TransitionHandler()
+		self.transitions.lambdas = header['lambdas']
+		self.transitions.token_N = header['token_N']
+		self.transitions.array = arrays['transitions']
+		self.transitions.log_array = arrays.get('log_transitions')
+		self.emissions = EmissionHandler(self.converter)
+		self.emissions.token_N = header['token_N']
+		self.emissions.theta = header['theta']
+		self.emissions.emission_N = header['emission_N']
+		self.emissions.indptr = arrays['indptr']
+		self.emissions.states = arrays['states']
+		self.emissions.probs = arrays['probs']
+		self.emissions.log_probs = arrays.get('log_probs')
+		if 'suffix_table' in arrays:
+			suffixes = _unpack_symbols(arrays['suffix_vocab'])
+			self.emissions.suffix_index = {s: n for n, s 
+											in enumerate(suffixes)}
+			self.emissions.suffix_table = arrays['suffix_table']
+	
 	@staticmethod
 	def test_POS():
 		#testfile = "/home/peterpersson/lin503/projekt/universal_treebanks_v2.0/std/de-universal-train.conll"
@@ -200,6 +650,34 @@ class Model():
 		m.save_at("chunk_model_UD_en.pickle")
 		m.load_from("chunk_model_UD_en.pickle")
 		print(m.get_state_N(), m.get_emission_N())
+	
+	@staticmethod
+	def test_update(testfile):
+		"""Checks that training on the first half of testfile, tagging 
+		and updating with the second half gives the model trained on 
+		all of testfile"""
+		import os
+		import tempfile
+		from hmm import HMM
+		with tempfile.TemporaryDirectory() as tmp:
+			halves = [os.path.join(tmp, name) for name in ('a', 'b')]
+			(start, middle), (middle, end) = _split_at_sentences(testfile, 2)
+			with open(testfile, 'rb') as inf:
+				for half, size in zip(halves, (middle, end - middle)):
+					with open(half, 'wb') as outf:
+						outf.write(inf.read(size))
+			tokens = ['zzunknown_word', 'qqq_other']
+			full, m = Model(), Model()
+			full.train(testfile)
+			m.train(halves[0])
+			HMM().viterbi(tokens, m)
+			m.update(halves[1])
+		assert m.get_emission_N() == full.get_emission_N()
+		assert (m.emissions.probs == full.emissions.probs).all()
+		assert (m.transitions.array == full.transitions.array).all()
+		assert list(HMM().viterbi(tokens, m)) == \
+				list(HMM().viterbi(tokens, full))
+		print(m.get_state_N(), m.get_emission_N())
 """
 if __name__ == '__main__':
 	Model.test_POS()
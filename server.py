@@ -0,0 +1,413 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  server.py
+#
+#  Copyright 2015 Peter Persson <peter.johan.persson@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import os
+import sys
+import json
+import signal
+import asyncio
+from collections import deque
+from time import perf_counter
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from chunker import Chunker, CHUNK, POS, beam_arg, beam_width_arg
+
+#  names of the modes in requests
+MODES = {'chunk': CHUNK, 'pos': POS}
+
+class TaggingServer:
+	"""Tags sentences sent over a socket with models kept in memory
+
+	The protocol is one JSON object per line both ways. A request
+	{"id": ..., "tokens": [...], "mode": "chunk"} is answered by
+	{"id": ..., "tags": [...]}, mode being "chunk" (the default) or
+	"pos" and id being anything, sent back as it is. {"id": ...,
+	"command": "stats"} is answered by {"id": ..., "stats": {...}}, see
+	stats(). Bad requests are answered by {"id": ..., "error": "..."}.
+	A connection may send any number of requests without waiting for
+	the answers, which come in the order their batches are decoded.
+
+	Requests are queued and a batcher takes them off the queue. The
+	requests that arrive within max_delay seconds of the first, up to
+	max_batch, are handed together to a thread that tags them one 
+	after the other with Chunker.tag, so that the server keeps 
+	accepting requests meanwhile. Only the hand over is batched, each
+	sentence is decoded on its own: sentences of a batch mostly differ
+	in length, so Chunker.tag_batch would gain nothing on them. At most
+	max_queue requests wait in the queue, a connection is not read 
+	further while it is full. A request line longer than max_line bytes
+	is answered by an error and ends its connection.
+
+	attributes:
+		chunker (Chunker): the chunker with the models loaded
+		max_batch (int): most sentences handed to the decoding 
+			thread at once
+		max_delay (float): seconds a request waits for others to
+			join its batch
+		max_queue (int): most requests waiting to be decoded
+		max_line (int): longest request line in bytes
+		latencies (deque): seconds from request to answer of the most
+			recent requests
+		port (int): TCP port listened on, None on a Unix socket
+
+	methods:
+		start([host, port, path]): starts listening, on a Unix socket
+			if path is given
+		stop(): answers the requests in flight with an error, closes 
+			the connections and stops, removing a Unix socket
+		stats(): returns latency percentiles, queue depth and batch
+			sizes as dict"""
+	def __init__(self, chunker, max_batch=64, max_delay=0.005,
+				 max_queue=1024, max_line=1 << 20, window=10000):
+		self.chunker = chunker
+		self.max_batch = max_batch
+		self.max_delay = max_delay
+		self.max_queue = max_queue
+		self.max_line = max_line
+		self.latencies = deque(maxlen=window)
+		self.port = None
+		self._path = None
+		self._queue = None
+		self._server = None
+		self._batcher = None
+		self._readers = set()
+		self._connections = set()
+		self._stopping = False
+		self._executor = ThreadPoolExecutor(1)
+		self._counts = {'requests': 0, 'batches': 0, 'errors': 0,
+						'queue_max': 0}
+
+	async def start(self, host='127.0.0.1', port=0, path=None):
+		"""Starts listening, port 0 picks a free port"""
+		self._queue = asyncio.Queue(self.max_queue)
+		self._batcher = asyncio.ensure_future(self._run_batches())
+		if path:
+			self._path = path
+			self._server = await asyncio.start_unix_server(self._serve,
+											path, limit=self.max_line)
+		else:
+			self._server = await asyncio.start_server(self._serve, host,
+											port, limit=self.max_line)
+			self.port = self._server.sockets[0].getsockname()[1]
+
+	async def stop(self):
+		"""Stops listening and decoding
+		
+		Requests that are queued or being decoded are answered with an 
+		error. Connections are then read no further and closed once 
+		their answers are sent."""
+		self._stopping = True
+		self._server.close()
+		self._batcher.cancel()
+		try:
+			await self._batcher
+		except asyncio.CancelledError:
+			pass
+		for reader in self._readers: reader.feed_eof()
+		if self._connections: await asyncio.wait(self._connections)
+		await self._server.wait_closed()
+		self._executor.shutdown()
+		if self._path and os.path.exists(self._path): os.remove(self._path)
+
+	def stats(self):
+		"""Returns latency percentiles in ms, queue depth and batches
+
+		Percentiles are over the most recent requests, counts over
+		all requests since the start."""
+		latencies = sorted(self.latencies)
+		report = dict(self._counts)
+		report['queue_depth'] = self._queue.qsize() if self._queue else 0
+		report['mean_batch'] = self._counts['requests'] / \
+								max(self._counts['batches'], 1)
+		for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+						('max', 1.0)):
+			report[name + '_ms'] = _percentile(latencies, q) * 1000
+		return report
+
+	async def _serve(self, reader, writer):
+		"""Answers the requests of one connection"""
+		pending = set()
+		self._readers.add(reader)
+		self._connections.add(asyncio.current_task())
+		try:
+			while True:
+				try:
+					line = await reader.readline()
+				except ValueError:
+					#  the rest of the line cannot be told from requests
+					answer = asyncio.get_running_loop().create_future()
+					answer.set_result(self._error(None, ValueError(
+						"request line longer than {} bytes".format(
+							self.max_line))))
+					pending.add(asyncio.ensure_future(self._send(writer, 
+																 answer)))
+					break
+				if not line: break
+				#  waits while the queue is full
+				answer = await self._submit(line, perf_counter())
+				pending.add(asyncio.ensure_future(self._send(writer, 
+															 answer)))
+				pending = set(task for task in pending if not task.done())
+			if pending: await asyncio.wait(pending)
+		finally:
+			self._readers.discard(reader)
+			self._connections.discard(asyncio.current_task())
+			writer.close()
+	
+	async def _send(self, writer, answer):
+		try:
+			writer.write(json.dumps(await answer).encode('utf-8') + b"\n")
+			await writer.drain()
+		except ConnectionError:
+			pass #  the client is gone
+	
+	async def _submit(self, line, start):
+		"""Parses a request line and queues its sentence for decoding
+		
+		Returns a future of the answer, which is already done for bad 
+		requests and stats."""
+		key, answer = None, asyncio.get_running_loop().create_future()
+		try:
+			request = json.loads(line.decode('utf-8'))
+			key = request.get('id')
+			if request.get('command') == 'stats':
+				answer.set_result({'id': key, 'stats': self.stats()})
+				return answer
+			tokens = request['tokens']
+			if request.get('mode', 'chunk') not in MODES:
+				raise ValueError("mode must be chunk or pos")
+			mode = MODES[request.get('mode', 'chunk')]
+			if not tokens or not isinstance(tokens, list) or \
+					not all(isinstance(token, str) for token in tokens):
+				raise ValueError("tokens must be a list of strings")
+			if mode == CHUNK and not self.chunker.chunk_model:
+				raise ValueError("no chunk model loaded")
+			if self._stopping: raise ConnectionError("server stopped")
+			future = asyncio.get_running_loop().create_future()
+			await self._queue.put((tokens, mode, future))
+			self._counts['queue_max'] = max(self._counts['queue_max'], 
+											self._queue.qsize())
+			#  the batcher may have stopped while the queue was full
+			if self._stopping: self._fail_queued()
+		except Exception as e:
+			answer.set_result(self._error(key, e))
+			return answer
+		return asyncio.ensure_future(self._answer(key, future, start))
+	
+	async def _answer(self, key, future, start):
+		"""Returns the answer to a request once future has its tags"""
+		try:
+			tags = await future
+		except Exception as e:
+			return self._error(key, e)
+		self._counts['requests'] += 1
+		self.latencies.append(perf_counter() - start)
+		return {'id': key, 'tags': tags}
+	
+	def _error(self, key, e):
+		self._counts['errors'] += 1
+		return {'id': key, 'error': "{}: {}".format(type(e).__name__, e)}
+	
+	def _fail_queued(self, batch=()):
+		"""Answers the requests of batch and the queue with an error"""
+		batch = list(batch)
+		while not self._queue.empty(): batch.append(self._queue.get_nowait())
+		for tokens, mode, future in batch:
+			if not future.done():
+				future.set_exception(ConnectionError("server stopped"))
+	
+	async def _run_batches(self):
+		"""Takes batches of requests off the queue and decodes them
+		
+		When cancelled the requests not yet decoded are answered with
+		an error."""
+		loop = asyncio.get_running_loop()
+		batch = []
+		try:
+			while True:
+				batch = [await self._queue.get()]
+				deadline = loop.time() + self.max_delay
+				while len(batch) < self.max_batch:
+					if not self._queue.empty():
+						batch.append(self._queue.get_nowait())
+						continue
+					timeout = deadline - loop.time()
+					if timeout <= 0: break
+					try:
+						batch.append(await asyncio.wait_for(
+											self._queue.get(), timeout))
+					except asyncio.TimeoutError:
+						break
+				self._counts['batches'] += 1
+				results = await loop.run_in_executor(self._executor,
+													 self._decode, batch)
+				for (tokens, mode, future), tags in zip(batch, results):
+					if future.done(): continue
+					if isinstance(tags, Exception): 
+						future.set_exception(tags)
+					else: future.set_result(tags)
+		finally:
+			self._fail_queued(batch)
+
+	def _decode(self, batch):
+		"""Tags the requests of a batch one by one, in the decoding thread
+		
+		Returns the tags of each request, or the exception raised when
+		tagging it."""
+		results = []
+		for tokens, mode, future in batch:
+			try:
+				results.append(self.chunker.tag(tokens, mode))
+			except Exception as e:
+				results.append(e)
+		return results
+
+def _percentile(values, q):
+	"""Returns the nearest rank q percentile of sorted values, or 0"""
+	if not values: return 0.0
+	rank = int(q * len(values) + 0.5)
+	return values[min(len(values), max(rank, 1)) - 1]
+
+class TaggingClient:
+	"""Client of a TaggingServer, in the same process or another
+
+	Requests are sent without waiting for earlier answers, so that
+	concurrent calls of tag can be batched together by the server.
+
+	attributes:
+		host (string), port (int), path (string): where the server
+			listens, on a Unix socket if path is given
+
+	methods:
+		connect(): opens the connection
+		tag(tokens[, mode]): returns the tags of a list of tokens
+		stats(): returns the stats of the server
+		close(): closes the connection"""
+	def __init__(self, host='127.0.0.1', port=None, path=None):
+		self.host, self.port, self.path = host, port, path
+		self._reader, self._writer = None, None
+		self._waiting, self._next_id, self._listener = {}, 0, None
+
+	async def __aenter__(self):
+		await self.connect()
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+	async def connect(self):
+		if self.path:
+			self._reader, self._writer = await asyncio.open_unix_connection(
+											self.path)
+		else:
+			self._reader, self._writer = await asyncio.open_connection(
+											self.host, self.port)
+		self._listener = asyncio.ensure_future(self._listen())
+
+	async def close(self):
+		self._writer.close()
+		self._listener.cancel()
+		try:
+			await self._listener
+		except asyncio.CancelledError:
+			pass
+
+	async def tag(self, tokens, mode='chunk'):
+		"""Returns the tags of tokens, mode is "chunk" or "pos"
+
+		Raises RuntimeError with the message of the server if it could
+		not tag them."""
+		answer = await self._request({'tokens': list(tokens), 'mode': mode})
+		return answer['tags']
+
+	async def stats(self):
+		return (await self._request({'command': 'stats'}))['stats']
+
+	async def _request(self, request):
+		self._next_id += 1
+		request['id'] = self._next_id
+		future = asyncio.get_running_loop().create_future()
+		self._waiting[request['id']] = future
+		self._writer.write(json.dumps(request).encode('utf-8') + b"\n")
+		await self._writer.drain()
+		answer = await future
+		if 'error' in answer: raise RuntimeError(answer['error'])
+		return answer
+
+	async def _listen(self):
+		"""Hands the answers of the server to the waiting requests"""
+		while True:
+			line = await self._reader.readline()
+			if not line: break
+			answer = json.loads(line.decode('utf-8'))
+			future = self._waiting.pop(answer.get('id'), None)
+			if future and not future.done(): future.set_result(answer)
+		for future in self._waiting.values():
+			if not future.done():
+				future.set_exception(ConnectionError("server closed"))
+
+def init_args():
+	parser = ArgumentParser(description="Serves POS and chunk tagging over a socket with the models kept in memory.")
+	parser.add_argument("-p", "--pos-model", type=str, required=True, help="POS model to tag with")
+	parser.add_argument("-c", "--chunk-model", type=str, help="chunk model to tag with, only POS tagging without it")
+	parser.add_argument("--host", type=str, default='127.0.0.1', help="address to listen on (default 127.0.0.1)")
+	parser.add_argument("--port", type=int, default=8040, help="TCP port to listen on (default 8040)")
+	parser.add_argument("--unix", type=str, help="listen on a Unix socket at this path instead of TCP")
+	parser.add_argument("--max-batch", type=int, default=64, help="most sentences handed to the decoding thread together (default 64)")
+	parser.add_argument("--max-queue", type=int, default=1024, help="most sentences waiting to be decoded, reading waits while this many are queued (default 1024)")
+	parser.add_argument("--max-line", type=int, default=1 << 20, help="longest request line in bytes, longer lines are answered by an error and end the connection (default 1048576)")
+	parser.add_argument("--max-delay", type=float, default=5.0, help="milliseconds a sentence waits for others to batch with (default 5)")
+	parser.add_argument("-l", "--log-space", action="store_true", help="decode with log probabilities")
+	parser.add_argument("--beam", type=beam_arg, default=1/1000, help="prune states less probable than this times the best (default 0.001)")
+	parser.add_argument("--beam-width", type=beam_width_arg, default=0, help="keep at most this many states per column in the beam, 0 for no limit")
+	parser.add_argument("--sentence-cache", type=int, default=0, help="remember the tags of this many recent sentences, 0 to turn off")
+	return parser.parse_args()
+
+def main(args):
+	chunker = Chunker(log_space=args.log_space, beam=args.beam,
+					  beam_width=args.beam_width,
+					  sentence_cache_size=args.sentence_cache)
+	chunker.load_model(args.pos_model, mode=POS)
+	if args.chunk_model: chunker.load_model(args.chunk_model, mode=CHUNK)
+	server = TaggingServer(chunker, args.max_batch, args.max_delay / 1000,
+						   args.max_queue, args.max_line)
+	loop = asyncio.new_event_loop()
+	loop.run_until_complete(server.start(args.host, args.port, args.unix))
+	print("Listening on", args.unix or "{}:{}".format(args.host,
+		  server.port), file=sys.stderr)
+	try:
+		loop.add_signal_handler(signal.SIGTERM, loop.stop)
+	except NotImplementedError:
+		pass
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		loop.run_until_complete(server.stop())
+		loop.close()
+
+if __name__ == '__main__':
+	main(init_args())
@@ -22,13 +22,13 @@
 #  
 # 
  
-from textutils import ConllParser
+from textutils import ConllParser, ConllReader, ConllWriter
 from collections import deque
 
 class Translator:
 	"""Converts universal stanford dependencies into IOB2 tags
 	
-	Reads through a file using parse_tree method from textutils, then 
+	Reads through a file using build_tree method from textutils, then 
 	converts the tree into a list representation of phrases which is
 	then finally turned into IOB2 tags. Discontinuous phrases are 
 	treated as separate chunks and the set of chunk types used is the 
@@ -51,22 +51,20 @@ class Translator:
 		"""Write a copy of infile at outfile enriched with IOB-2 tags
 		
 		infile must be a .conll file with standford dependencies. 
-		column is where in the file the new annotation will go. 
+		column is where in the file the new annotation will go. The 
+		file is read by a ConllReader and the tags are spliced into a 
+		copy of its lines by a ConllWriter. Sentences that are not 
+		connected trees are left out.
 		"""
-		with open(infile, 'r') as inf, open(outfile, 'w') as outf:
-			source_lines = [1]
-			while source_lines[-1]: 
-				#  bool(source_lines[-1]) is false when last line is EOF
-				tree, source_lines = self.conll.parse_tree(inf, keep_lines=True)
+		with ConllReader(infile) as reader, open(outfile, 'wb') as outf, \
+				ConllWriter(outf, reader.buffer) as writer:
+			for spans, parents, dep_types, tags in reader.offsets(column, 
+					ConllParser.PARENT, ConllParser.DEP, ConllParser.TAG):
+				tree = self.conll.build_tree(parents, dep_types, tags)
 				if not tree: continue
-				chunk_tags = self.translate_tree(tree)
-				for i, line in enumerate(source_lines):
-					if line == '\n': outf.write(line)
-					elif line == '': continue
-					else:
-						data = line.split("\t")
-						data[column] = chunk_tags[i]
-						outf.write("\t".join(data))
+				writer.splice(spans, self.translate_tree(tree))
+				#  the blank line that ends the sentence
+				if spans[-1, 3] < reader.end: writer.write(b"\n")
 	
 	def translate_tree(self, tree):
 		"""Finds chunks from tree, returning list of IOB2 tags
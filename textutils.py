@@ -22,6 +22,12 @@
 #  
 #  
 
+import io
+import os
+import re
+import codecs
+import mmap
+import stat
 from collections import deque
 
 class Node:
@@ -64,28 +70,6 @@ class Tokenizer:
 class ConllParser:
 	"""Contains all .conll reading functions."""
 	TOKEN, TAG, CHUNK, PARENT, DEP = 1, 3, 5, 6, 7
-	def parse_line_POS(self, line):
-		"""Used by model to train for POS tagging.
-		
-		Returns (token, tag)."""
-		data = line.split('\t')
-		suffixes = self.find_suffixes(data[ConllParser.TOKEN])
-		return (data[ConllParser.TOKEN], data[ConllParser.TAG], suffixes)
-	
-	def parse_line_CHUNK(self, line):
-		"""Used by model to train for chunk tagging.
-		
-		Returns (tag, chunk)."""
-		data = line.split('\t')
-		return (data[ConllParser.TAG], data[ConllParser.CHUNK])
-	
-	def parse_line_EVAL(self, line):
-		"""Used by evaluation function.
-		
-		Returns (token, chunk)."""
-		data = line.split('\t')
-		return (data[ConllParser.TOKEN], data[ConllParser.CHUNK])
-	
 	def parse_line_TAG(self, line):
 		"""Used by tagging function.
 		
@@ -94,12 +78,61 @@ class ConllParser:
 		return data[ConllParser.TOKEN]
 		
 	
+	def iter_sentences(self, fileobject):
+		"""Generates the sentences of a .conll file one at a time
+		
+		Sentences are deliminated by blank lines. A last sentence that 
+		is not followed by a blank line is generated as well. Only one
+		sentence is held in memory at a time.
+		
+		Yields (tokens, raw_lines) as two lists of strings."""
+		sentence, raw_lines = [], []
+		for line in fileobject:
+			if line != "\n":
+				sentence.append(self.parse_line_TAG(line))
+				raw_lines.append(line)
+			elif sentence:
+				yield sentence, raw_lines
+				sentence, raw_lines = [], []
+		if sentence:
+			yield sentence, raw_lines
+	
 	def find_suffixes(self, token):
 		"""Returns all suffix strings up to length 10."""
 		MAX_M = 10
 		return [token[-i:] for i in range(min(len(token), MAX_M))]
 	
 	
+	def build_tree(self, parents, dep_types, tags):
+		"""Generates syntax tree from the columns of one sentence
+		
+		parents, dep_types and tags hold the stanford dependency parent,
+		dependency type and POS tag of each token as strings. The tree 
+		is represented as by parse_tree.
+		
+		Returns a list representation of stanford tree, or an empty 
+		list if the tree is not connected."""
+		tree = ["ROOT"]
+		for parent, dep_type, tag in zip(parents, dep_types, tags):
+			tree.append(Node(int(parent), dep_type, tag, len(tree)))
+		for i in range(1, len(tree)):
+			node = tree[i]
+			if node.parent != 0:
+				tree[node.parent].add_child(node)
+			else: tree[0] = i
+		#  check for connected tree
+		try:
+			counter = 0
+			children = deque([tree[0]])
+			while children:
+				node = tree[children.popleft()]
+				children.extend(node.children)
+				counter += 1
+			if counter == len(tree) - 1: return tree
+		except:
+			pass
+		return []
+	
 	def parse_tree(self, fileobject, keep_lines=False):
 		"""Reads one sentence from fileobject and generates syntax tree
 		
@@ -114,35 +147,15 @@ class ConllParser:
 		source_lines = []
 		line = fileobject.readline()
 		source_lines.append(line)
-		tree = ["ROOT"]
+		columns = []
 		while line not in STOP:
 			data = line.split('\t')
-			tree.append(Node(int(data[ConllParser.PARENT]), 
-							 data[ConllParser.DEP], 
-							 data[ConllParser.TAG], 
-							 len(tree)))
+			columns.append((data[ConllParser.PARENT], data[ConllParser.DEP],
+							data[ConllParser.TAG]))
 			line = fileobject.readline()
 			source_lines.append(line)
-		for i in range(1, len(tree)):
-			node = tree[i]
-			if node.parent != 0:
-				tree[node.parent].add_child(node)
-			else: tree[0] = i
-		#  check for connected tree
-		try:
-			counter = 1
-			children = deque([tree[0]])
-			while children:
-				node = tree[children.popleft()]
-				children.extend(node.children)
-				counter += 1
-			if counter == len(source_lines): corrupt = False
-			else: corrupt = True 
-		except:
-			corrupt = True
-		if keep_lines and corrupt: return [], source_lines
-		elif keep_lines: return tree, source_lines
-		elif corrupt: return []
+		tree = self.build_tree(*zip(*columns)) if columns else []
+		if keep_lines: return tree, source_lines
 		return tree
 	
 	@staticmethod
@@ -159,6 +172,264 @@ class ConllParser:
 			
 
 
+#  a blank line, which ends a sentence
+_BLANK = re.compile(rb'\n\r?\n')
+
+class ConllReader:
+	"""Bulk reader of chosen columns of a .conll file
+	
+	The file is memory mapped, or read whole if it cannot be, and taken
+	a block of whole sentences at a time. Blocks end at the first blank
+	line found by a search of the bytes past block_size. Each block is 
+	decoded at once and only the columns asked for are split off its 
+	lines. Column numbers are those of ConllParser, lines may end in 
+	\n or \r\n. With start and end only that byte range is read, it 
+	should begin and end at sentence boundaries.
+	
+	attributes:
+		buffer (mmap or bytes): contents of the file
+		start (int): byte offset at which reading starts
+		end (int): byte offset at which reading ends
+		block_size (int): least number of bytes decoded at a time
+		encoding (string): encoding of the file
+	
+	methods:
+		mappable(fileobject): tells if fileobject can be memory mapped
+		sentences(*columns): generates the given columns of each 
+			sentence
+		iter_sentences(): generates (tokens, raw_lines) like 
+			ConllParser.iter_sentences
+		offsets(column, *columns): generates the byte offsets in buffer
+			of column with the given columns of each sentence
+		close(): unmaps and closes the file"""
+	def __init__(self, source, start=0, end=None, block_size=1 << 20, 
+				 encoding='utf-8'):
+		"""source is a filename or a file object, in text or binary mode"""
+		self._file = None
+		if isinstance(source, str):
+			source = self._file = open(source, 'rb')
+		if self.mappable(source) and os.fstat(source.fileno()).st_size:
+			self.buffer = mmap.mmap(source.fileno(), 0, 
+									access=mmap.ACCESS_READ)
+		else:
+			data = getattr(source, 'buffer', source).read()
+			if isinstance(data, str): data = data.encode(encoding)
+			self.buffer = data
+		self.start = start
+		self.end = len(self.buffer) if end is None else end
+		self.block_size = block_size
+		self.encoding = encoding
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.close()
+	
+	def close(self):
+		if isinstance(self.buffer, mmap.mmap): self.buffer.close()
+		if self._file: self._file.close()
+	
+	@staticmethod
+	def mappable(fileobject):
+		"""Returns True if fileobject is a regular file on disk"""
+		try:
+			return stat.S_ISREG(os.fstat(fileobject.fileno()).st_mode)
+		except (AttributeError, OSError, ValueError):
+			return False
+	
+	def _blocks(self):
+		"""Generates (offset, bytes) of blocks of whole sentences"""
+		pos = self.start
+		while pos < self.end:
+			stop = pos + self.block_size
+			if stop < self.end:
+				blank = _BLANK.search(self.buffer, stop - 1, self.end)
+				stop = blank.end() if blank else self.end
+			else: stop = self.end
+			yield pos, self.buffer[pos:stop]
+			pos = stop
+	
+	def _split(self):
+		"""Generates the lines of each sentence, without line breaks"""
+		for offset, block in self._blocks():
+			yield from self._split_block(block)
+	
+	def _split_block(self, block):
+		"""Returns the lines of each sentence of block"""
+		text = block.decode(self.encoding)
+		if '\r' in text: text = text.replace('\r\n', '\n')
+		return [sentence.strip('\n').split('\n') 
+					for sentence in text.split('\n\n') 
+						if sentence.strip('\n')]
+	
+	def sentences(self, *columns):
+		"""Generates the given columns of each sentence
+		
+		Yields a list of strings for one column, otherwise a tuple with
+		a list per column."""
+		split_N = max(columns) + 1
+		if len(columns) == 1:
+			column = columns[0]
+			for lines in self._split():
+				yield [line.split('\t', split_N)[column] for line in lines]
+			return
+		for lines in self._split():
+			yield _columns(lines, columns, split_N)
+	
+	def iter_sentences(self):
+		"""Generates the sentences of the file as (tokens, raw_lines)
+		
+		The raw lines end in \n, except the last line of a file that 
+		does not, like the lines read by ConllParser.iter_sentences."""
+		TOKEN, sentence = ConllParser.TOKEN, None
+		split_N = TOKEN + 1
+		for lines in self._split():
+			if sentence: yield sentence
+			sentence = ([line.split('\t', split_N)[TOKEN] for line in lines],
+						[line + '\n' for line in lines])
+		if sentence:
+			if self.buffer[self.end - 1:self.end] != b'\n':
+				sentence[1][-1] = sentence[1][-1][:-1]
+			yield sentence
+	
+	def offsets(self, column, *columns):
+		"""Generates byte offsets of column in buffer, by sentence
+		
+		The offsets of a block are found at once with numpy, from the 
+		positions of its line breaks and tabs. 
+		
+		Yields a tuple of a numpy.ndarray with a row for each line of a
+		sentence, holding the offsets at which the line starts, column 
+		starts, column ends and the next line starts, followed by a list
+		of strings for each of the given columns."""
+		from numpy import frombuffer, uint8, flatnonzero, concatenate, \
+						  searchsorted, cumsum, column_stack, minimum
+		split_N = max((column,) + columns) + 1
+		for offset, block in self._blocks():
+			sentences = self._split_block(block)
+			data = frombuffer(block, uint8)
+			breaks = flatnonzero(data == 10)
+			starts = concatenate(([0], breaks + 1))
+			ends = concatenate((breaks, [len(data)]))
+			nexts = concatenate((breaks + 1, [len(data)]))
+			#  \r of \r\n is not part of the line
+			cr = ends > starts
+			cr[cr] = data[ends[cr] - 1] == 13
+			ends -= cr
+			full = ends > starts
+			starts, ends, nexts = starts[full], ends[full], nexts[full]
+			tabs = concatenate((flatnonzero(data == 9), [len(data)]))
+			first = searchsorted(tabs, starts)
+			if column:
+				before = tabs[minimum(first + column - 1, len(tabs) - 1)]
+				if (before >= ends).any():
+					raise IndexError("line without column " + str(column))
+				field_starts = before + 1
+				after = tabs[minimum(first + column, len(tabs) - 1)]
+			else:
+				field_starts, after = starts, tabs[first]
+			spans = column_stack((starts, field_starts, minimum(after, ends),
+								  nexts)) + offset
+			bounds = cumsum([0] + [len(lines) for lines in sentences])
+			for n, lines in enumerate(sentences):
+				yield (spans[bounds[n]:bounds[n + 1]],) + \
+						_columns(lines, columns, split_N)
+
+class ConllWriter:
+	"""Buffered writer of a .conll buffer with new tags spliced in
+	
+	Sentences are copied from the buffer of a ConllReader with a new 
+	tag in place of one column on each line, using the offsets found 
+	by ConllReader.offsets, so lines are never split or joined again. 
+	The copied bytes are gathered until buffer_size bytes are waiting,
+	then written to outfile at once. The bytes are copied as they are,
+	so outfile must take them in the encoding of the source, see 
+	writable.
+	
+	attributes:
+		outfile: the binary file written to, the underlying buffer of 
+			a text file
+		source (mmap or bytes): the buffer copied from
+		buffer_size (int): bytes gathered before they are written
+		encoding (string): encoding of the tags
+	
+	methods:
+		writable(outfile, encoding): tells if bytes in encoding can be
+			written to outfile
+		splice(spans, tags): copies the lines of a sentence with tags
+		write(data): adds bytes to the output
+		flush(): writes out the gathered bytes
+		close(): writes out the gathered bytes"""
+	def __init__(self, outfile, source, buffer_size=1 << 20, 
+				 encoding='utf-8'):
+		if hasattr(outfile, 'buffer'):
+			#  text written before must come first
+			outfile.flush()
+			outfile = outfile.buffer
+		self.outfile = outfile
+		self.source = source
+		self.buffer_size = buffer_size
+		self.encoding = encoding
+		self._pieces, self._size, self._tags = [], 0, {}
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.close()
+	
+	@staticmethod
+	def writable(outfile, encoding='utf-8'):
+		"""Returns True if bytes in encoding can be written to outfile
+		
+		That is if outfile is a binary file, or a text file over a 
+		binary buffer with the same encoding. Text files without one, 
+		such as io.StringIO, only take strings."""
+		if hasattr(outfile, 'buffer'):
+			return codecs.lookup(outfile.encoding).name == \
+					codecs.lookup(encoding).name
+		return isinstance(outfile, (io.RawIOBase, io.BufferedIOBase))
+	
+	def splice(self, spans, tags):
+		"""Copies the lines of a sentence with tags in the spliced column
+		
+		spans are the rows yielded by ConllReader.offsets for the 
+		sentence, the lines are copied from the start of the first to 
+		the start of the line after the last, blank lines thus not."""
+		source, pieces, encoded = self.source, self._pieces, self._tags
+		rows = spans.tolist()
+		pos = rows[0][0]
+		for (line_start, start, end, line_end), tag in zip(rows, tags):
+			pieces.append(source[pos:start])
+			data = encoded.get(tag)
+			if data is None: data = encoded[tag] = tag.encode(self.encoding)
+			pieces.append(data)
+			pos = end
+		pieces.append(source[pos:rows[-1][3]])
+		self._size += rows[-1][3] - rows[0][0]
+		if self._size >= self.buffer_size: self.flush()
+	
+	def write(self, data):
+		self._pieces.append(data)
+		self._size += len(data)
+		if self._size >= self.buffer_size: self.flush()
+	
+	def flush(self):
+		if self._pieces:
+			self.outfile.write(b''.join(self._pieces))
+			self._pieces, self._size = [], 0
+		self.outfile.flush()
+	
+	def close(self):
+		"""Writes out the gathered bytes, the outfile is left open"""
+		self.flush()
+
+def _columns(lines, columns, split_N):
+	"""Returns a list of the fields of each of columns in lines"""
+	fields = [line.split('\t', split_N) for line in lines]
+	return tuple([data[column] for data in fields] for column in columns)
+
 if __name__ == '__main__':
 	ConllParser.test_tree("/home/corpora/universal_treebanks_v2.0/std/de/de-universal-dev.conll")
 